@@ -11,7 +11,7 @@ import os
 # start time
 start_time = time.time()
 # 1️⃣ Charger le modèle ArcFace
-model = insightface.app.FaceAnalysis()
+model = insightface.app.FaceAnalysis(allowed_modules=['detection', 'recognition'])  # ni âge/genre ni landmarks
 model.prepare(ctx_id=0)  # -1 = CPU, ctx_id=0 pour GPU
 
 # Dossier des images
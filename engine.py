@@ -1,5 +1,4 @@
 import time
-import insightface
 import numpy as np
 import cv2
 import os
@@ -7,125 +6,2251 @@ import faiss
 import shutil
 import argparse
 import pickle
+import threading
+import multiprocessing
+import re
+import struct
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 # Globals
 MODEL = None
 
-def load_model(ctx_id=-1):
-    """Charger le modèle ArcFace (singleton)."""
+# Fichiers écrits par `build` dans le dossier de données
+DATA_DIR = 'data'
+INDEX_FILE = 'index.faiss'
+EMBEDDINGS_FILE = 'embeddings.bin'
+PHOTO_IDS_FILE = 'photo_ids.npy'
+PHOTOS_FILE = 'photos.npy'
+BBOXES_FILE = 'bboxes.npy'
+META_FILE = 'meta.pkl'
+VERSION_FILE = 'index.version'
+CLUSTERS_FILE = 'clusters.pkl'
+# Miniatures web des photos indexées, générées au build / update (voir `sync_thumbnails`)
+THUMBNAILS_DIR = 'thumbnails'
+THUMBNAIL_SIDE = 512
+# Version du format du dossier de données, enregistrée dans la métadata
+DATA_FORMAT = 2
+# Anciens formats, toujours lisibles : .npy float32 et un chemin par visage (format 1), npz + pickle
+V1_EMBEDDINGS_FILE = 'embeddings.npy'
+V1_PATHS_FILE = 'image_paths.npy'
+LEGACY_EMBEDDINGS_FILE = 'embeddings.npz'
+# Un sous-dossier (shard) par événement : <data_dir>/events/<event_id>/
+EVENTS_DIR = 'events'
+# Budget mémoire des index gardés en cache par `get_index` (octets)
+INDEX_CACHE_BYTES = 2 * 1024 ** 3
+
+# Prétraitement des images avant détection (voir `configure`)
+PREPROCESS = {
+    'max_side': None,             # côté max des images passées au modèle, None = pleine résolution
+    'det_size': 640,              # taille d'entrée du détecteur
+    'adaptive_det_size': False,   # entrée du détecteur au format de l'image (et réduite pour les petites images)
+    'light_models': True,         # charger seulement la détection et la reconnaissance
+    # Préfiltres de `embed_images` (build / update)
+    'prefilter_side': None,       # chercher un visage sur une miniature de ce côté avant le décodage complet
+    'dedupe_distance': None,      # distance de Hamming max entre dHash d'une rafale, None = pas de dédoublonnage
+    'time_budget': None,          # secondes max par image (décodage + détection), au-delà pas de reconnaissance
+    # Vidéos (voir `embed_videos`)
+    'video_fps': 2.0,             # images de la vidéo examinées par seconde
+    'video_scene_distance': 12,   # distance dHash entre images examinées au-delà de laquelle la scène a changé
+    'video_max_gap': 2.0,         # secondes max sans détection (scène fixe), et sans visage avant de clore une piste
+    'video_track_iou': 0.3,       # IoU min entre un visage et la dernière position d'une piste pour la prolonger
+    'video_samples': 3,           # embeddings représentatifs par piste de visage
+}
+# Exécution des modèles (voir `configure`)
+INFERENCE = {
+    'batch_size': 32,             # visages alignés passés ensemble au modèle de reconnaissance
+    'intra_op_threads': None,     # threads onnxruntime par opérateur, None = défaut onnxruntime (tous les coeurs)
+    'inter_op_threads': None,     # threads onnxruntime entre opérateurs
+    'fork_preload': False,        # processus d'inférence forkés depuis un modèle chargé une fois (voir `_embed_parallel`)
+}
+# Durées de démarrage (secondes), remplies par `load_model` et `warm_up`
+STARTUP = {'model_load_s': None, 'warmup_s': None}
+# Options qui demandent de recharger le modèle
+_MODEL_OPTIONS = ('det_size', 'light_models', 'intra_op_threads', 'inter_op_threads')
+
+
+def configure(**options):
+    """Modifie le prétraitement (clés de PREPROCESS) et l'inférence (clés de INFERENCE).
+
+    Le modèle est rechargé si det_size, light_models ou les threads onnxruntime changent.
+    """
+    global MODEL
+    current = {**PREPROCESS, **INFERENCE}
+    unknown = set(options) - set(current)
+    if unknown:
+        raise ValueError(f"Options inconnues : {', '.join(sorted(unknown))}")
+    if any(name in options and options[name] != current[name] for name in _MODEL_OPTIONS):
+        MODEL = None
+    PREPROCESS.update({name: value for name, value in options.items() if name in PREPROCESS})
+    INFERENCE.update({name: value for name, value in options.items() if name in INFERENCE})
+
+
+def load_model(ctx_id=-1, intra_op_threads=None):
+    """Charger le modèle ArcFace (singleton).
+
+    intra_op_threads limite les threads onnxruntime par session (utile avec plusieurs processus d'inférence),
+    par défaut INFERENCE['intra_op_threads'].
+    Avec PREPROCESS['light_models'] (par défaut), seuls les modèles de détection et de reconnaissance sont
+    chargés (pas d'âge/genre ni de landmarks, inutiles pour la recherche).
+    insightface n'est importé qu'ici : importer engine reste rapide pour les commandes sans inférence.
+    """
     global MODEL
     if MODEL is None:
-        MODEL = insightface.app.FaceAnalysis()
-        MODEL.prepare(ctx_id=ctx_id)
+        import insightface.app
+        start = time.perf_counter()
+        kwargs = {}
+        intra_op_threads = intra_op_threads or INFERENCE['intra_op_threads']
+        inter_op_threads = INFERENCE['inter_op_threads']
+        if intra_op_threads or inter_op_threads:
+            import onnxruntime
+            sess_options = onnxruntime.SessionOptions()
+            if intra_op_threads:
+                sess_options.intra_op_num_threads = intra_op_threads
+            sess_options.inter_op_num_threads = inter_op_threads or 1
+            kwargs['sess_options'] = sess_options
+        if PREPROCESS['light_models']:
+            kwargs['allowed_modules'] = ['detection', 'recognition']
+        MODEL = insightface.app.FaceAnalysis(**kwargs)
+        if 'sess_options' in kwargs:
+            _apply_session_options(MODEL, kwargs['sess_options'])
+        det_size = PREPROCESS['det_size']
+        MODEL.prepare(ctx_id=ctx_id, det_size=(det_size, det_size))
+        STARTUP['model_load_s'] = time.perf_counter() - start
     return MODEL
 
 
-def get_face_embeddings(img_path, ctx_id=-1):
+def _apply_session_options(model, sess_options):
+    """Recrée les sessions onnxruntime des modèles qui n'ont pas reçu sess_options.
+
+    insightface 0.7.3 (version du backend) ne transmet à onnxruntime que providers / provider_options :
+    sans cela, intra_op_threads et inter_op_threads resteraient sans effet et chaque processus d'inférence
+    utiliserait tous les coeurs.
+    """
+    from insightface.model_zoo.model_zoo import PickableInferenceSession
+    wanted = (sess_options.intra_op_num_threads, sess_options.inter_op_num_threads)
+    for task_model in model.models.values():
+        options = task_model.session.get_session_options()
+        if (options.intra_op_num_threads, options.inter_op_num_threads) == wanted:
+            continue
+        task_model.session = PickableInferenceSession(task_model.model_file, sess_options=sess_options,
+                                                      providers=task_model.session.get_providers())
+
+
+def session_threads(model):
+    """{tâche: (intra_op_num_threads, inter_op_num_threads)} des sessions onnxruntime du modèle (0 : défaut)."""
+    threads = {}
+    for taskname, task_model in model.models.items():
+        options = task_model.session.get_session_options()
+        threads[taskname] = (options.intra_op_num_threads, options.inter_op_num_threads)
+    return threads
+
+
+def warm_up(ctx_id=-1):
+    """Charge le modèle et fait une première détection et une première reconnaissance sur des images vides.
+
+    Le premier appel onnxruntime alloue ses buffers : le faire au démarrage évite de le payer sur la première
+    requête. Retourne STARTUP.
+    """
+    model = load_model(ctx_id=ctx_id)
+    start = time.perf_counter()
+    det_size = PREPROCESS['det_size']
+    model.det_model.detect(np.zeros((det_size, det_size, 3), dtype=np.uint8), input_size=(det_size, det_size),
+                           max_num=0, metric='default')
+    rec_model = model.models['recognition']
+    rec_model.get_feat([np.zeros((rec_model.input_size[1], rec_model.input_size[0], 3), dtype=np.uint8)])
+    STARTUP['warmup_s'] = time.perf_counter() - start
+    return STARTUP
+
+
+# Octets lus pour trouver les dimensions d'un JPEG (les segments EXIF/ICC précèdent l'en-tête SOF)
+_JPEG_HEADER_BYTES = 256 * 1024
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def _jpeg_size(head):
+    """(largeur, hauteur) lues dans l'en-tête SOF d'un JPEG, ou None."""
+    if head[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(head):
+        if head[i] != 0xFF:
+            return None
+        marker = head[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(head[i + 7:i + 9], 'big'), int.from_bytes(head[i + 5:i + 7], 'big')
+        i += 2 + int.from_bytes(head[i + 2:i + 4], 'big')
+    return None
+
+
+def load_image(image, max_side=None):
+    """Décode l'image, réduite à max_side pixels de côté si demandé, sans fichier temporaire.
+
+    Pour un JPEG plus grand que max_side, le décodage se fait directement à 1/2, 1/4 ou 1/8 de la
+    résolution (IMREAD_REDUCED_*, bien plus rapide qu'un décodage complet), puis l'image est réduite
+    à max_side si nécessaire.
+    Args:
+        image: chemin (str), contenu encodé (bytes, bytearray, memoryview : JPEG, PNG...) ou tableau BGR.
+        max_side (int): côté max, None pour la pleine résolution.
+    Returns:
+        (img BGR ou None si illisible, échelle) avec échelle = taille originale / taille retournée.
+    """
+    size = None
+    if isinstance(image, np.ndarray):
+        img = image
+    else:
+        is_buffer = isinstance(image, (bytes, bytearray, memoryview))
+        flag = cv2.IMREAD_COLOR
+        if max_side:
+            if is_buffer:
+                head = bytes(memoryview(image)[:_JPEG_HEADER_BYTES])
+            else:
+                try:
+                    with open(image, 'rb') as f:
+                        head = f.read(_JPEG_HEADER_BYTES)
+                except OSError:
+                    head = b''
+            size = _jpeg_size(head)
+            if size:
+                for factor, reduced_flag in _REDUCED_FLAGS:
+                    if max(size) / factor >= max_side:
+                        flag = reduced_flag
+                        break
+        if is_buffer:
+            buffer = np.frombuffer(image, dtype=np.uint8)
+            img = cv2.imdecode(buffer, flag) if buffer.size else None
+        else:
+            img = cv2.imread(image, flag)
+        if img is None:
+            return None, 1.0
+    scale = max(size) / max(img.shape[:2]) if size else 1.0
+    if max_side and max(img.shape[:2]) > max_side:
+        factor = max_side / max(img.shape[:2])
+        img = cv2.resize(img, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+        scale /= factor
+    return img, scale
+
+
+def decode_image(image, max_side=None):
+    """Retourne l'image en tableau BGR (ou None si illisible), sans fichier temporaire (voir `load_image`)."""
+    return load_image(image, max_side=max_side)[0]
+
+
+def detect_faces(image, ctx_id=-1, timings=None):
+    """Retourne les visages insightface (embedding, bbox, det_score...) d'une image (voir `load_image`).
+
+    L'image est prétraitée selon PREPROCESS ; bbox et kps sont en coordonnées de l'image originale.
+    timings (dict) cumule les secondes par étape : 'decode', 'detect', 'embed' (voir `_faces_batch`).
+    """
+    return detect_faces_batch([image], ctx_id=ctx_id, timings=timings)[0]
+
+
+def detect_faces_batch(images, ctx_id=-1, batch_size=None, timings=None):
+    """Comme `detect_faces` pour une liste d'images : les visages alignés de toutes les images passent
+    dans le modèle de reconnaissance par lots de batch_size (défaut INFERENCE['batch_size']).
+
+    Retourne une liste de listes de visages, une par image, dans l'ordre de `images`.
+    """
+    model = load_model(ctx_id=ctx_id)
+
+    def decoded():
+        for image in images:
+            start = time.perf_counter()
+            item = load_image(image, max_side=PREPROCESS['max_side'])
+            if timings is not None:
+                timings['decode'] = timings.get('decode', 0.0) + time.perf_counter() - start
+            yield item
+    return _faces_batch(model, decoded(), batch_size=batch_size, timings=timings)
+
+
+def get_face_embeddings(image, ctx_id=-1):
     """Retourne la liste des embeddings (numpy arrays) pour toutes les faces trouvées dans l'image.
 
     Args:
-        img_path (str): chemin vers l'image.
+        image: chemin vers l'image, contenu encodé (bytes / memoryview) ou tableau BGR.
         ctx_id (int): contexte pour insightface (-1 CPU, 0 GPU).
     Returns:
         list[numpy.array]
     """
+    return [f.embedding for f in detect_faces(image, ctx_id=ctx_id)]
+
+
+def get_face_embeddings_batch(images, ctx_id=-1, batch_size=None):
+    """Embeddings de plusieurs images, reconnaissance par lots (voir `detect_faces_batch`).
+
+    Returns:
+        list[list[numpy.array]] : une liste d'embeddings par image.
+    """
+    return [[f.embedding for f in faces] for faces in detect_faces_batch(images, ctx_id=ctx_id, batch_size=batch_size)]
+
+
+def detector_input_size(img):
+    """Taille d'entrée (largeur, hauteur) du détecteur pour cette image.
+
+    Sans adaptive_det_size : carré det_size x det_size. Avec : le côté long vaut det_size (ou moins
+    pour une petite image) et le côté court suit le format de l'image, arrondi à un multiple de 32,
+    ce qui évite de détecter sur des bandes de padding (un tiers de l'entrée pour une photo 3:2).
+    """
+    det_size = PREPROCESS['det_size']
+    if not PREPROCESS['adaptive_det_size']:
+        return det_size, det_size
+    h, w = img.shape[:2]
+    long_side = min(det_size, int(np.ceil(max(h, w) / 32)) * 32)
+    short_side = max(32, int(np.ceil(long_side * min(h, w) / max(h, w) / 32)) * 32)
+    return (long_side, short_side) if w >= h else (short_side, long_side)
+
+
+def _faces_batch(model, decoded, batch_size=None, timings=None, time_budget=None):
+    """Équivalent de FaceAnalysis.get pour plusieurs images, avec la reconnaissance par lots.
+
+    decoded : itérable de (img BGR ou None, échelle), voir `load_image`. Chaque image est détectée seule
+    (taille d'entrée de `detector_input_size`), puis ses visages alignés (112x112) s'ajoutent au lot en attente :
+    le modèle de reconnaissance est appelé une fois par lot de batch_size visages, toutes images confondues,
+    au lieu d'une fois par visage. Seuls les visages alignés restent en mémoire, pas les images.
+    bbox et kps sont multipliés par l'échelle (coordonnées de l'image originale). timings (dict) cumule les
+    secondes passées en détection ('detect') et dans les autres modèles, reconnaissance comprise ('embed').
+    Les éléments de decoded peuvent porter un 3e terme, les secondes déjà passées à décoder : avec time_budget,
+    une image dont décodage + détection dépasse le budget n'est pas encodée et son résultat vaut None.
+    Retourne une liste (une par image) de listes de visages.
+    """
+    from insightface.app.common import Face
+    from insightface.utils.face_align import norm_crop
+    batch_size = batch_size or INFERENCE['batch_size']
+    rec_model = model.models.get('recognition')
+    results, crops, pending = [], [], []
+
+    def embed(count):
+        start = time.perf_counter()
+        features = rec_model.get_feat(crops[:count])
+        for face, feature in zip(pending[:count], features):
+            face.embedding = feature.flatten()
+        del crops[:count], pending[:count]
+        if timings is not None:
+            timings['embed'] = timings.get('embed', 0.0) + time.perf_counter() - start
+
+    for item in decoded:
+        img, scale = item[0], item[1]
+        faces = []
+        if img is not None:
+            start = time.perf_counter()
+            bboxes, kpss = model.det_model.detect(img, input_size=detector_input_size(img), max_num=0,
+                                                  metric='default')
+            detected = time.perf_counter()
+            if time_budget and (item[2] if len(item) > 2 else 0.0) + detected - start > time_budget:
+                results.append(None)
+                continue
+            for i in range(bboxes.shape[0]):
+                face = Face(bbox=bboxes[i, 0:4], kps=None if kpss is None else kpss[i], det_score=bboxes[i, 4])
+                for taskname, task_model in model.models.items():
+                    if taskname not in ('detection', 'recognition'):
+                        task_model.get(img, face)
+                if rec_model is not None:
+                    crops.append(norm_crop(img, landmark=face.kps, image_size=rec_model.input_size[0]))
+                    pending.append(face)
+                faces.append(face)
+            if timings is not None:
+                timings['detect'] = timings.get('detect', 0.0) + detected - start
+                timings['embed'] = timings.get('embed', 0.0) + time.perf_counter() - detected
+            if scale != 1.0:
+                for face in faces:
+                    face.bbox = face.bbox * scale
+                    if face.kps is not None:
+                        face.kps = face.kps * scale
+        results.append(faces)
+        while len(crops) >= batch_size:
+            embed(batch_size)
+    if crops:
+        embed(len(crops))
+    return results
+
+
+def _image_faces(model, img, scale=1.0, timings=None):
+    """Visages d'une image décodée (voir `_faces_batch`)."""
+    return _faces_batch(model, [(img, scale)], timings=timings)[0]
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def list_images(image_folder):
+    """Chemins des images du dossier, triés pour un ordre d'indexation stable."""
+    return [os.path.join(image_folder, filename) for filename in sorted(os.listdir(image_folder))
+            if filename.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v')
+# Clé d'un visage de vidéo dans la table des photos : <chemin>#t=<secondes> (fragment temporel des Media Fragments)
+VIDEO_TIME_SEP = '#t='
+
+
+def list_videos(image_folder):
+    """Chemins des vidéos du dossier, triés."""
+    return [os.path.join(image_folder, filename) for filename in sorted(os.listdir(image_folder))
+            if filename.lower().endswith(VIDEO_EXTENSIONS)]
+
+
+def media_key(path, timestamp):
+    return f'{path}{VIDEO_TIME_SEP}{timestamp:.2f}'
+
+
+def split_media_key(key):
+    """(fichier, secondes) d'une clé de la table des photos ; secondes vaut None pour une photo."""
+    key = str(key)
+    source, sep, timestamp = key.rpartition(VIDEO_TIME_SEP)
+    if not sep:
+        return key, None
+    try:
+        return source, float(timestamp)
+    except ValueError:
+        return key, None
+
+
+def iter_decoded(paths, decode_threads=1, load=None):
+    """Décode les images dans l'ordre de `paths` et produit des tuples (path, (img BGR ou None, échelle)).
+
+    Les images sont réduites selon PREPROCESS['max_side'] (voir `load_image`) ; load(path) remplace ce décodage.
+    Avec decode_threads > 1, les images suivantes sont décodées en parallèle pendant l'inférence,
+    au plus 2 * decode_threads images d'avance (file bornée, la mémoire reste limitée avec des JPEG de 20+ MP).
+    """
+    if load is None:
+        max_side = PREPROCESS['max_side']
+
+        def load(path):
+            return load_image(path, max_side=max_side)
+    if decode_threads <= 1:
+        for path in paths:
+            yield path, load(path)
+        return
+    with ThreadPoolExecutor(max_workers=decode_threads) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(load, path)))
+            if len(pending) >= 2 * decode_threads:
+                done_path, future = pending.popleft()
+                yield done_path, future.result()
+        while pending:
+            done_path, future = pending.popleft()
+            yield done_path, future.result()
+
+
+def _ceil32(n):
+    return max(32, int(np.ceil(n / 32)) * 32)
+
+
+def _load_checked(path, model):
+    """Décode une image pour `_embed_paths` en appliquant prefilter_side et time_budget (voir PREPROCESS).
+
+    Avec prefilter_side, une miniature (décodage JPEG réduit, quelques ms) passe d'abord dans le détecteur :
+    sans visage, l'image n'est pas décodée en entier. Les très petits visages (foule lointaine) peuvent
+    disparaître sur la miniature : plus prefilter_side est grand, moins le filtre en manque.
+    Retourne (img ou None, échelle, secondes, motif) avec motif 'faceless', 'timeout' ou None.
+    """
+    start = time.perf_counter()
+    side = PREPROCESS['prefilter_side']
+    if side:
+        thumb, _ = load_image(path, max_side=side)
+        if thumb is not None:
+            h, w = thumb.shape[:2]
+            bboxes, _ = model.det_model.detect(thumb, input_size=(_ceil32(w), _ceil32(h)), max_num=0,
+                                               metric='default')
+            if not len(bboxes):
+                return None, 1.0, time.perf_counter() - start, 'faceless'
+    img, scale = load_image(path, max_side=PREPROCESS['max_side'])
+    elapsed = time.perf_counter() - start
+    if PREPROCESS['time_budget'] and elapsed > PREPROCESS['time_budget']:
+        return None, 1.0, elapsed, 'timeout'
+    return img, scale, elapsed, None
+
+
+def _embed_paths(paths, ctx_id=-1, decode_threads=1):
+    """Retourne [(path, embeddings (n, 512) float32, bboxes (n, 4) float32, motif, secondes de décodage)]
+    dans l'ordre de `paths` ; motif vaut 'faceless', 'timeout' (voir `_load_checked`) ou None."""
     model = load_model(ctx_id=ctx_id)
-    img = cv2.imread(img_path)
-    if img is None:
-        return []
-    faces = model.get(img)
-    embeddings = [f.embedding for f in faces]
-    return embeddings
+    checks = {}
+
+    def load(path):
+        img, scale, seconds, status = _load_checked(path, model)
+        checks[path] = (status, seconds)
+        return img, scale, seconds
+    all_faces = _faces_batch(model, (decoded for _, decoded in iter_decoded(paths, decode_threads=decode_threads,
+                                                                            load=load)),
+                             time_budget=PREPROCESS['time_budget'])
+    results = []
+    for path, faces in zip(paths, all_faces):
+        status, seconds = checks[path]
+        if faces is None:
+            status, faces = 'timeout', []
+        embeddings = np.array([f.embedding for f in faces], dtype='float32').reshape(len(faces), 512)
+        bboxes = np.array([f.bbox for f in faces], dtype='float32').reshape(len(faces), 4)
+        results.append((path, embeddings, bboxes, status, seconds))
+    return results
 
 
-def build_embeddings(image_folder, output_folder='data/similar_images', ctx_id=-1):
-    """Parcourt le dossier d'images et construit les tableaux d'embeddings et métadata.
+# État des processus d'inférence de `embed_images` (un FaceAnalysis par processus)
+_WORKER_CONFIG = {}
 
-    Sauvegarde les résultats dans `data/embeddings.npz` et `data/meta.pkl`.
-    Retourne (embeddings_array, image_paths, num_faces_per_image, output_folder)
+
+def _init_worker(ctx_id, intra_op_threads, decode_threads, options):
+    cv2.setNumThreads(1)
+    configure(**options)
+    load_model(ctx_id=ctx_id, intra_op_threads=intra_op_threads)
+    _WORKER_CONFIG.update(ctx_id=ctx_id, decode_threads=decode_threads)
+
+
+def _embed_chunk(paths):
+    return _embed_paths(paths, ctx_id=_WORKER_CONFIG['ctx_id'], decode_threads=_WORKER_CONFIG['decode_threads'])
+
+
+def _embed_parallel(paths, ctx_id, workers, decode_threads, chunk_size):
+    """Répartit les images par lots sur `workers` processus, au plus 2 lots en attente par processus.
+
+    Avec INFERENCE['fork_preload'] (CPU, systèmes avec fork), le modèle est chargé et préchauffé une fois ici
+    puis hérité par les processus forkés : pas de chargement par processus, et les poids sont partagés en
+    copy-on-write. Une session onnxruntime n'est utilisable après fork que sans pool de threads : le modèle
+    est chargé avec un seul thread (vérifié avec `session_threads`, sinon spawn), puis INFERENCE et le modèle
+    du processus appelant sont rétablis à la fin.
     """
-    os.makedirs(output_folder, exist_ok=True)
+    global MODEL
+    intra_op_threads = INFERENCE['intra_op_threads'] or max(1, (os.cpu_count() or 1) // workers)
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    results = [None] * len(chunks)
+    saved_inference, saved_model = dict(INFERENCE), MODEL
+    # spawn par défaut : une session onnxruntime multi-thread ne survit pas à un fork
+    mp_context = multiprocessing.get_context('spawn')
+    try:
+        if INFERENCE['fork_preload'] and ctx_id < 0 and 'fork' in multiprocessing.get_all_start_methods():
+            configure(intra_op_threads=1, inter_op_threads=1)
+            warm_up(ctx_id=ctx_id)
+            if all(threads == (1, 1) for threads in session_threads(MODEL).values()):
+                intra_op_threads = 1
+                mp_context = multiprocessing.get_context('fork')
+            else:
+                print("fork_preload ignoré : sessions onnxruntime multi-thread, processus lancés en spawn")
+                INFERENCE.update(saved_inference)
+                MODEL = saved_model
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker,
+                                 initargs=(ctx_id, intra_op_threads, decode_threads,
+                                           {**PREPROCESS, **INFERENCE})) as pool:
+            pending = {}
+            for position, chunk in enumerate(chunks):
+                pending[pool.submit(_embed_chunk, chunk)] = position
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[pending.pop(future)] = future.result()
+            for future in list(pending):
+                results[pending.pop(future)] = future.result()
+    finally:
+        # Le modèle à un thread ne sert qu'aux processus forkés : l'appelant retrouve ses réglages et son modèle
+        INFERENCE.update(saved_inference)
+        MODEL = saved_model
+    # Les lots sont réassemblés par position : l'ordre ne dépend pas du nombre de processus
+    return [item for chunk_results in results for item in chunk_results]
+
+
+# Nombre d'images précédentes (dans l'ordre des chemins) comparées pour trouver une rafale
+DEDUPE_WINDOW = 8
+
+
+def image_dhash(img):
+    """Hash perceptuel (dHash 64 bits) : signe des différences horizontales d'une vignette 9x8 en niveaux de gris.
+
+    Deux photos d'une même rafale ont des hash à quelques bits près (distance de Hamming).
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int(np.packbits(small[:, 1:] > small[:, :-1]).view('>u8')[0])
+
+
+def _path_dhash(path):
+    thumb, _ = load_image(path, max_side=128)
+    return None if thumb is None else image_dhash(thumb)
+
+
+def find_duplicates(paths, max_distance, decode_threads=1, window=DEDUPE_WINDOW):
+    """Photos quasi identiques (rafales) : pour chaque image, une des `window` images précédentes dans l'ordre
+    de paths dont le dHash est à distance de Hamming <= max_distance.
+
+    Retourne {chemin du doublon: chemin de l'image de référence}, la référence n'étant jamais elle-même un doublon.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, decode_threads)) as pool:
+        hashes = list(pool.map(_path_dhash, paths))
+    duplicates = {}
+    for i, image_hash in enumerate(hashes):
+        if image_hash is None:
+            continue
+        for j in range(max(0, i - window), i):
+            if hashes[j] is not None and bin(image_hash ^ hashes[j]).count('1') <= max_distance:
+                duplicates[paths[i]] = duplicates.get(paths[j], paths[j])
+                break
+    return duplicates
+
+
+def embed_images(paths, ctx_id=-1, workers=1, decode_threads=1, chunk_size=4, stats=None):
+    """Calcule les embeddings d'une liste d'images.
+
+    Avec workers > 1, l'inférence tourne dans `workers` processus (chacun avec son propre FaceAnalysis),
+    alimentés par `decode_threads` threads de décodage par processus. Le résultat est dans l'ordre de `paths`
+    quel que soit le nombre de processus.
+    Préfiltres (voir PREPROCESS) : les doublons de rafale (dedupe_distance, voir `find_duplicates`) reprennent
+    les visages de leur image de référence sans inférence ; les images sans visage sur la miniature
+    (prefilter_side) ou hors budget (time_budget) sont enregistrées sans visage. Le budget est vérifié après
+    le décodage (détection évitée) puis après la détection (reconnaissance évitée) : il ne borne pas le
+    temps passé, il évite les étapes suivantes.
+    stats (dict) reçoit les compteurs : images, faceless, duplicates, timeouts, prefilter_s et
+    estimated_saved_s (temps moyen d'une image complète fois les images évitées, moins le coût des filtres),
+    ainsi que timed_out, les chemins hors budget (doublons compris) à laisser hors du manifest pour qu'un
+    `update` les réessaie.
+    Retourne (embeddings_array, image_paths, num_faces_per_image, bboxes) où image_paths et bboxes
+    (x1, y1, x2, y2) ont une entrée par visage ; les embeddings sont normalisés L2 (voir `normalize_embeddings`).
+    """
+    paths = list(paths)
+    start = time.perf_counter()
+    duplicates = {}
+    if PREPROCESS['dedupe_distance'] is not None:
+        duplicates = find_duplicates(paths, PREPROCESS['dedupe_distance'], decode_threads=decode_threads)
+    hash_s = time.perf_counter() - start
+    to_embed = [path for path in paths if path not in duplicates]
+    if workers > 1 and len(to_embed) > chunk_size:
+        per_image = _embed_parallel(to_embed, ctx_id, workers, decode_threads, chunk_size)
+    else:
+        per_image = _embed_paths(to_embed, ctx_id=ctx_id, decode_threads=decode_threads)
+    embed_s = time.perf_counter() - start - hash_s
+
+    by_path = {path: (embeddings, bboxes) for path, embeddings, bboxes, _, _ in per_image}
+    statuses = [status for _, _, _, status, _ in per_image]
+    faceless_s = sum(seconds for _, _, _, status, seconds in per_image if status == 'faceless')
+    processed = statuses.count(None)
+    counters = {
+        'images': len(paths),
+        'faceless': statuses.count('faceless'),
+        'duplicates': len(duplicates),
+        'timeouts': statuses.count('timeout'),
+        'prefilter_s': hash_s + faceless_s,
+    }
+    timed_out = {path for path, _, _, status, _ in per_image if status == 'timeout'}
+    average_s = (embed_s - faceless_s) / processed if processed else 0.0
+    counters['estimated_saved_s'] = (counters['faceless'] + counters['duplicates']) * average_s - counters['prefilter_s']
+    if stats is not None:
+        stats.update(counters)
+        stats['timed_out'] = [path for path in paths if duplicates.get(path, path) in timed_out]
+    if duplicates or counters['faceless'] or counters['timeouts']:
+        print(f"Images sans visage ignorées : {counters['faceless']}, doublons de rafale : {counters['duplicates']}, "
+              f"hors budget : {counters['timeouts']}, temps gagné estimé : {counters['estimated_saved_s']:.1f} s")
+
     embeddings_list = []
+    bboxes_list = []
     image_paths = []
     num_faces_per_image = {}
 
-    for filename in os.listdir(image_folder):
-        if not filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            continue
-        path = os.path.join(image_folder, filename)
-        embeddings = get_face_embeddings(path, ctx_id=ctx_id)
+    for path in paths:
+        embeddings, bboxes = by_path[duplicates.get(path, path)]
         num_faces_per_image[path] = len(embeddings)
-        for emb in embeddings:
-            embeddings_list.append(emb)
-            image_paths.append(path)
+        if len(embeddings):
+            embeddings_list.append(embeddings)
+            bboxes_list.append(bboxes)
+            image_paths.extend([path] * len(embeddings))
 
     if len(embeddings_list) == 0:
         embeddings_array = np.empty((0, 512), dtype='float32')
+        bboxes = np.empty((0, 4), dtype='float32')
     else:
-        embeddings_array = np.array(embeddings_list).astype('float32')
+        embeddings_array = normalize_embeddings(np.concatenate(embeddings_list))
+        bboxes = np.concatenate(bboxes_list)
+    return embeddings_array, image_paths, num_faces_per_image, bboxes
+
+
+def _box_iou(box, boxes):
+    """IoU d'une bbox (x1, y1, x2, y2) avec chaque ligne de boxes (n, 4)."""
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum((box[2] - box[0]) * (box[3] - box[1]) + areas - inter, 1e-6)
+
+
+def video_tracks(model, path, stats=None):
+    """Parcourt une vidéo et suit les visages d'une image examinée à l'autre (voir PREPROCESS, video_*).
+
+    Seules video_fps images par seconde sont décodées (les autres sont sautées par `grab`, sans décodage).
+    Parmi elles, la détection ne tourne que si des visages sont suivis, si la scène a changé (distance dHash
+    > video_scene_distance, ce qui clôt aussi les pistes en cours) ou après video_max_gap secondes : une scène
+    fixe sans personne coûte une détection toutes les video_max_gap secondes.
+    Un visage prolonge la piste dont la dernière bbox le recouvre le plus (IoU >= video_track_iou) ; une piste
+    sans visage depuis video_max_gap secondes est close. Chaque piste garde ses video_samples meilleurs visages
+    alignés (score de détection x taille), pas encore encodés.
+    stats (dict) reçoit frames, sampled, analyzed et tracks.
+    Retourne une liste de pistes {'start': secondes, 'samples': [(qualité, bbox, visage aligné 112x112)]}.
+    """
+    from insightface.utils.face_align import norm_crop
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        return []
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    step = max(1, int(round(fps / PREPROCESS['video_fps'])))
+    max_gap = PREPROCESS['video_max_gap']
+    n_samples = PREPROCESS['video_samples']
+    rec_model = model.models['recognition']
+    active, finished = [], []
+    counters = {'frames': 0, 'sampled': 0, 'analyzed': 0}
+    last_hash, last_analyzed = None, None
+    frame_index = -1
+    try:
+        while capture.grab():
+            frame_index += 1
+            if frame_index % step:
+                continue
+            ok, frame = capture.retrieve()
+            if not ok:
+                break
+            counters['sampled'] += 1
+            timestamp = frame_index / fps
+            frame_hash = image_dhash(frame)
+            scene_change = last_hash is not None and \
+                bin(frame_hash ^ last_hash).count('1') > PREPROCESS['video_scene_distance']
+            if scene_change:
+                finished.extend(active)
+                active = []
+            if not (active or scene_change or last_analyzed is None or timestamp - last_analyzed >= max_gap):
+                continue
+            last_hash, last_analyzed = frame_hash, timestamp
+            counters['analyzed'] += 1
+
+            scale = 1.0
+            max_side = PREPROCESS['max_side']
+            if max_side and max(frame.shape[:2]) > max_side:
+                scale = max_side / max(frame.shape[:2])
+                frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            bboxes, kpss = model.det_model.detect(frame, input_size=detector_input_size(frame), max_num=0,
+                                                  metric='default')
+            matched = set()
+            for i in np.argsort(-bboxes[:, 4]):
+                box = bboxes[i, :4]
+                ious = _box_iou(box, np.array([track['bbox'] for track in active]).reshape(-1, 4))
+                candidates = [(iou, t) for t, iou in enumerate(ious) if t not in matched]
+                iou, t = max(candidates, default=(0.0, None))
+                if t is None or iou < PREPROCESS['video_track_iou']:
+                    active.append({'start': timestamp, 'samples': []})
+                    t = len(active) - 1
+                track = active[t]
+                matched.add(t)
+                track.update(bbox=box, last_seen=timestamp)
+                quality = float(bboxes[i, 4]) * float(np.sqrt(max((box[2] - box[0]) * (box[3] - box[1]), 0.0)))
+                if len(track['samples']) < n_samples or quality > track['samples'][-1][0]:
+                    crop = norm_crop(frame, landmark=kpss[i], image_size=rec_model.input_size[0])
+                    track['samples'] = sorted(track['samples'] + [(quality, box / scale, crop)],
+                                              key=lambda sample: -sample[0])[:n_samples]
+            still_active = []
+            for track in active:
+                (still_active if timestamp - track['last_seen'] < max_gap else finished).append(track)
+            active = still_active
+    finally:
+        counters['frames'] = frame_index + 1
+        capture.release()
+    finished.extend(active)
+    if stats is not None:
+        stats.update(counters, tracks=len(finished))
+    return finished
+
+
+def embed_videos(paths, ctx_id=-1, stats=None):
+    """Encode les visages de vidéos : quelques embeddings représentatifs par piste de visage (voir `video_tracks`),
+    et non un par image, donc un coût proportionnel aux apparitions distinctes plutôt qu'au nombre d'images.
+
+    Tous les visages d'une piste sont indexés sous la clé <vidéo>#t=<début de la piste> (voir `media_key`) : une
+    recherche retourne la vidéo et l'instant où la personne apparaît. stats (dict) cumule les compteurs de
+    `video_tracks` et le nombre de vidéos.
+    Retourne (embeddings_array, clés par visage, num_faces_per_image par vidéo, bboxes), comme `embed_images`.
+    """
+    model = load_model(ctx_id=ctx_id)
+    rec_model = model.models['recognition']
+    batch_size = INFERENCE['batch_size']
+    totals = {'videos': len(paths), 'frames': 0, 'sampled': 0, 'analyzed': 0, 'tracks': 0}
+    keys, bboxes, crops, num_faces_per_image = [], [], [], {}
+    for path in paths:
+        video_stats = {}
+        tracks = video_tracks(model, path, stats=video_stats)
+        for name, value in video_stats.items():
+            totals[name] += value
+        num_faces_per_image[path] = 0
+        for track in tracks:
+            for _, bbox, crop in track['samples']:
+                keys.append(media_key(path, track['start']))
+                bboxes.append(bbox)
+                crops.append(crop)
+                num_faces_per_image[path] += 1
+    embeddings = [rec_model.get_feat(crops[i:i + batch_size]) for i in range(0, len(crops), batch_size)]
+    embeddings_array = normalize_embeddings(np.concatenate(embeddings).astype('float32').reshape(-1, 512)) \
+        if embeddings else np.empty((0, 512), dtype='float32')
+    if stats is not None:
+        stats.update(totals)
+    if paths:
+        print(f"Vidéos : {totals['videos']}, images : {totals['frames']}, examinées : {totals['analyzed']}, "
+              f"pistes de visages : {totals['tracks']}, visages encodés : {len(keys)}")
+    return embeddings_array, keys, num_faces_per_image, np.asarray(bboxes, dtype='float32').reshape(-1, 4)
+
+
+def embed_media(paths, ctx_id=-1, workers=1, decode_threads=1, stats=None):
+    """`embed_images` pour les images de paths et `embed_videos` pour les vidéos, résultats concaténés.
+
+    stats : voir `embed_images` (compteurs des images seulement).
+    """
+    paths = list(paths)
+    videos = [path for path in paths if path.lower().endswith(VIDEO_EXTENSIONS)]
+    images = [path for path in paths if not path.lower().endswith(VIDEO_EXTENSIONS)]
+    embeddings_array, image_paths, num_faces_per_image, bboxes = embed_images(images, ctx_id=ctx_id, workers=workers,
+                                                                              decode_threads=decode_threads,
+                                                                              stats=stats)
+    if not videos:
+        return embeddings_array, image_paths, num_faces_per_image, bboxes
+    video_embeddings, video_keys, video_num_faces, video_bboxes = embed_videos(videos, ctx_id=ctx_id)
+    num_faces_per_image.update(video_num_faces)
+    return (np.concatenate([embeddings_array, video_embeddings]), list(image_paths) + video_keys, num_faces_per_image,
+            np.concatenate([bboxes, video_bboxes]))
+
+
+def _file_hash(path):
+    import hashlib
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_signature(path, use_hash=False):
+    """Signature d'un fichier pour le manifest : taille + mtime, et le sha1 du contenu si use_hash=True."""
+    st = os.stat(path)
+    signature = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if use_hash:
+        signature['sha1'] = _file_hash(path)
+    return signature
+
+
+def build_embeddings(image_folder, output_folder='data/similar_images', ctx_id=-1, data_dir=DATA_DIR, use_hash=False,
+                     workers=1, decode_threads=1, index_params=None, storage=None, thumbnail_side=THUMBNAIL_SIDE):
+    """Parcourt le dossier d'images (et de vidéos, voir `embed_videos`) et construit les tableaux d'embeddings et métadata.
+
+    Sauvegarde les résultats dans `data_dir` (voir `save_index`), avec le manifest des fichiers indexés
+    utilisé par `update_embeddings` (sans les images hors time_budget, ainsi réessayées).
+    workers / decode_threads : voir `embed_images` ;
+    index_params (index_type, nlist, nprobe, ef_search) : voir `build_faiss_index` ;
+    storage (float32, float16, pq) : voir `write_embeddings`.
+    thumbnail_side : côté des miniatures des photos avec visages (voir `sync_thumbnails`), None ou 0 pour aucune.
+    Retourne (embeddings_array, image_paths, num_faces_per_image, output_folder)
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    paths = list_images(image_folder) + list_videos(image_folder)
+    manifest = {path: file_signature(path, use_hash=use_hash) for path in paths}
+    stats = {}
+    embeddings_array, image_paths, num_faces_per_image, bboxes = embed_media(paths, ctx_id=ctx_id, workers=workers,
+                                                                             decode_threads=decode_threads, stats=stats)
+    # Les images hors budget restent hors du manifest : le prochain `update` les réencode
+    for path in stats.get('timed_out', []):
+        manifest.pop(path, None)
 
     # Save to disk for re-use
-    os.makedirs('data', exist_ok=True)
-    np.savez_compressed('data/embeddings.npz', embeddings=embeddings_array)
-    with open('data/meta.pkl', 'wb') as f:
-        pickle.dump({'image_paths': image_paths, 'num_faces_per_image': num_faces_per_image, 'output_folder': output_folder}, f)
+    save_index(embeddings_array, image_paths, num_faces_per_image, output_folder, data_dir=data_dir, manifest=manifest,
+               index_params=index_params, bboxes=bboxes, storage=storage)
+    if thumbnail_side:
+        sync_thumbnails(data_dir, image_paths, side=thumbnail_side, threads=decode_threads)
 
     print(f"Nombre de visages indexés : {len(embeddings_array)}")
     return embeddings_array, image_paths, num_faces_per_image, output_folder
 
 
-def load_embeddings():
-    """Charge embeddings et métadata depuis le disque. Retourne la même structure que build_embeddings()"""
-    if not os.path.exists('data/embeddings.npz') or not os.path.exists('data/meta.pkl'):
+def _unchanged(path, old_signature, use_hash):
+    """Compare un fichier à sa signature du manifest. Retourne (inchangé, signature courante)."""
+    signature = file_signature(path)
+    if old_signature is None:
+        return False, signature
+    if signature['size'] == old_signature['size'] and signature['mtime_ns'] == old_signature['mtime_ns']:
+        if 'sha1' in old_signature:
+            signature['sha1'] = old_signature['sha1']
+        return True, signature
+    if use_hash and signature['size'] == old_signature['size']:
+        # mtime modifié (copie, re-upload) : le contenu peut être identique
+        signature['sha1'] = _file_hash(path)
+        return signature['sha1'] == old_signature.get('sha1'), signature
+    return False, signature
+
+
+def update_embeddings(image_folder, output_folder=None, ctx_id=-1, data_dir=DATA_DIR, use_hash=False,
+                      workers=1, decode_threads=1, thumbnail_side=THUMBNAIL_SIDE):
+    """Met à jour l'index existant avec le contenu actuel du dossier d'images.
+
+    Seules les images nouvelles ou modifiées (selon le manifest : taille + mtime, ou sha1 si use_hash=True)
+    sont encodées ; les visages des images supprimées ou modifiées sont retirés de l'index.
+    Le type d'index choisi au build est conservé. Si aucun index n'existe encore, équivaut à `build_embeddings`.
+    Les miniatures des photos nouvelles ou modifiées sont générées, celles des photos retirées supprimées.
+    Retourne la même structure que build_embeddings().
+    """
+    try:
+        embeddings_array, image_paths, num_faces_per_image, old_output_folder = load_embeddings(data_dir)
+        meta = load_meta(data_dir)
+        bboxes = load_bboxes(data_dir)
+    except FileNotFoundError:
+        return build_embeddings(image_folder, output_folder=output_folder or 'data/similar_images',
+                                ctx_id=ctx_id, data_dir=data_dir, use_hash=use_hash,
+                                workers=workers, decode_threads=decode_threads, thumbnail_side=thumbnail_side)
+    output_folder = output_folder or old_output_folder
+    os.makedirs(output_folder, exist_ok=True)
+    image_paths = np.asarray(image_paths, dtype=str)
+
+    new_manifest = {}
+    to_embed = []
+    for path in list_images(image_folder) + list_videos(image_folder):
+        unchanged, signature = _unchanged(path, meta.get('manifest', {}).get(path), use_hash)
+        new_manifest[path] = signature
+        if not unchanged:
+            to_embed.append(path)
+    # Images supprimées du dossier, ou modifiées (réencodées ci-dessous)
+    stale = set(num_faces_per_image) - (set(new_manifest) - set(to_embed))
+
+    stats = {}
+    new_embeddings, new_paths, new_num_faces, new_bboxes = embed_media(to_embed, ctx_id=ctx_id, workers=workers,
+                                                                       decode_threads=decode_threads, stats=stats)
+    # Images hors budget : hors du manifest, réessayées au prochain update (voir `build_embeddings`)
+    for path in stats.get('timed_out', []):
+        new_manifest.pop(path, None)
+
+    embeddings_array, image_paths, removed = _apply_changes(
+        data_dir, embeddings_array, image_paths, num_faces_per_image, bboxes, stale,
+        new_embeddings, new_paths, new_num_faces, new_bboxes,
+        output_folder, manifest=new_manifest, index_params=meta.get('index_params'), storage=meta.get('storage'))
+    if thumbnail_side:
+        sync_thumbnails(data_dir, image_paths, side=thumbnail_side, threads=decode_threads)
+
+    print(f"Images encodées : {len(to_embed)}, images retirées : {len(stale - set(to_embed))}, "
+          f"visages retirés : {removed}, visages ajoutés : {len(new_embeddings)}")
+    print(f"Nombre de visages indexés : {len(embeddings_array)}")
+    return embeddings_array, image_paths, num_faces_per_image, output_folder
+
+
+def _apply_changes(data_dir, embeddings_array, image_paths, num_faces_per_image, bboxes, stale,
+                   new_embeddings, new_paths, new_num_faces, new_bboxes, output_folder, manifest=None, index_params=None,
+                   storage=None):
+    """Retire les visages des images `stale` (des vidéos : toutes leurs clés <vidéo>#t=...), ajoute les nouveaux
+    visages et sauvegarde l'index.
+
+    Retourne (embeddings_array, image_paths, nombre de visages retirés).
+    """
+    keep = np.ones(len(image_paths), dtype=bool)
+    if stale and len(image_paths):
+        parts = np.char.rpartition(np.asarray(image_paths, dtype=str), VIDEO_TIME_SEP)
+        sources = np.where(parts[:, 1] == VIDEO_TIME_SEP, parts[:, 0], parts[:, 2])
+        keep = ~np.isin(sources, list(stale))
+
+    # Sans index réutilisable (absent ou ancien index L2), save_index le reconstruit en entier.
+    # Seul l'index flat (float32, float16 ou PQ) renumérote les ids après remove_ids (IVF garde les anciens ids, HNSW ne supprime pas) :
+    # les autres types sont reconstruits quand des visages sont retirés.
+    index = load_faiss_index(data_dir)
+    removed_ids = np.flatnonzero(~keep)
+    if removed_ids.size and not isinstance(index, faiss.IndexFlatCodes):
+        index = None
+    if index is not None:
+        if removed_ids.size:
+            index.remove_ids(faiss.IDSelectorBatch(removed_ids.astype('int64')))
+        if new_embeddings.size:
+            index.add(new_embeddings)
+
+    if isinstance(embeddings_array, PQEmbeddings) and storage == 'pq':
+        # Le dictionnaire PQ est conservé : réentraîné sur des vecteurs déjà décodés, la perte se cumulerait
+        # à chaque update
+        embeddings_array = embeddings_array.extend(keep, new_embeddings)
+    else:
+        embeddings_array = np.concatenate([normalize_embeddings(embeddings_array[keep]), new_embeddings])
+    image_paths = list(image_paths[keep]) + list(new_paths)
+    bboxes = np.concatenate([bboxes[keep], new_bboxes])
+    for path in stale:
+        num_faces_per_image.pop(path, None)
+    num_faces_per_image.update(new_num_faces)
+
+    save_index(embeddings_array, image_paths, num_faces_per_image, output_folder, data_dir=data_dir,
+               manifest=manifest, index=index, index_params=index_params, bboxes=bboxes, storage=storage)
+    return embeddings_array, image_paths, int(removed_ids.size)
+
+
+def add_embeddings(new_embeddings, new_paths, new_num_faces, new_bboxes, data_dir=DATA_DIR,
+                   output_folder='data/similar_images'):
+    """Ajoute à l'index des visages déjà calculés (ex. jobs d'ingestion du backend), sans dossier d'images.
+
+    new_paths identifie la photo de chaque visage (chemin, URL ou identifiant) ; une photo déjà indexée
+    est remplacée. Les photos ajoutées ainsi ne sont pas dans le manifest : un `update` depuis un dossier
+    les retirerait, un même index ne doit donc pas mélanger les deux sources.
+    Crée l'index (flat) s'il n'existe pas. Retourne le nombre total de visages indexés.
+    """
+    try:
+        embeddings_array, image_paths, num_faces_per_image, output_folder = load_embeddings(data_dir)
+        meta = load_meta(data_dir)
+        bboxes = load_bboxes(data_dir)
+    except FileNotFoundError:
+        embeddings_array = np.zeros((0, 512), dtype='float32')
+        image_paths, num_faces_per_image, meta = [], {}, {}
+        bboxes = np.zeros((0, 4), dtype='float32')
+    image_paths = np.asarray(image_paths, dtype=str)
+    stale = set(new_num_faces) & set(num_faces_per_image)
+    new_embeddings = normalize_embeddings(np.asarray(new_embeddings, dtype='float32').reshape(-1, 512))
+    new_bboxes = np.asarray(new_bboxes, dtype='float32').reshape(-1, 4)
+    embeddings_array, _, _ = _apply_changes(
+        data_dir, embeddings_array, image_paths, num_faces_per_image, bboxes, stale,
+        new_embeddings, new_paths, new_num_faces, new_bboxes,
+        output_folder, manifest=meta.get('manifest'), index_params=meta.get('index_params'),
+        storage=meta.get('storage'))
+    return len(embeddings_array)
+
+
+def thumbnail_path(data_dir, photo_path):
+    """Chemin de la miniature d'une photo : nom dérivé du chemin de la photo, stable d'un build à l'autre."""
+    import hashlib
+    name = hashlib.sha1(str(photo_path).encode('utf-8')).hexdigest()[:20] + '.jpg'
+    return os.path.join(data_dir, THUMBNAILS_DIR, name)
+
+
+def video_frame(path, timestamp, max_side=None):
+    """Image BGR de la vidéo à `timestamp` secondes, réduite au côté max_side, ou None."""
+    capture = cv2.VideoCapture(path)
+    try:
+        capture.set(cv2.CAP_PROP_POS_MSEC, timestamp * 1000)
+        ok, frame = capture.read()
+    finally:
+        capture.release()
+    if not ok:
+        return None
+    if max_side and max(frame.shape[:2]) > max_side:
+        scale = max_side / max(frame.shape[:2])
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def _write_thumbnail(photo_path, path, side):
+    """Écrit la miniature si elle manque ou si la photo (la vidéo, pour une clé <vidéo>#t=...) est plus récente.
+    Retourne True si elle a été écrite."""
+    source, timestamp = split_media_key(photo_path)
+    try:
+        photo_mtime = os.stat(source).st_mtime_ns
+    except OSError:
+        return False  # identifiant sans fichier (photos ajoutées par `add_embeddings`)
+    if os.path.exists(path) and os.stat(path).st_mtime_ns >= photo_mtime:
+        return False
+    if timestamp is None:
+        img, _ = load_image(source, max_side=side)
+    else:
+        img = video_frame(source, timestamp, max_side=side)
+    if img is None:
+        return False
+    ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    if not ok:
+        return False
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.tobytes())
+    _atomic_write(path, write)
+    return True
+
+
+def sync_thumbnails(data_dir, photo_paths, side=THUMBNAIL_SIDE, threads=1):
+    """Met à jour les miniatures JPEG (côté max `side`, décodage JPEG réduit) des photos de photo_paths dans
+    <data_dir>/thumbnails : générées une fois à l'indexation, les recherches les servent sans jamais lire ni
+    déplacer les photos complètes.
+
+    Seules les miniatures manquantes ou plus anciennes que leur photo sont écrites, et celles des photos qui
+    ne sont plus indexées sont supprimées. Retourne le nombre de miniatures écrites.
+    """
+    folder = os.path.join(data_dir, THUMBNAILS_DIR)
+    os.makedirs(folder, exist_ok=True)
+    targets = {thumbnail_path(data_dir, photo): str(photo) for photo in set(np.asarray(photo_paths, dtype=str).tolist())}
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        written = sum(pool.map(lambda item: _write_thumbnail(item[1], item[0], side), targets.items()))
+    for name in os.listdir(folder):
+        if os.path.join(folder, name) not in targets:
+            os.remove(os.path.join(folder, name))
+    return written
+
+
+def _atomic_write(path, write):
+    """Écrit via un fichier temporaire puis `os.replace`, pour qu'un lecteur ne voie jamais un fichier à moitié écrit."""
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Stockage des embeddings dans EMBEDDINGS_FILE : en-tête versionné de 64 octets, centroïdes PQ éventuels,
+# puis les vecteurs bruts alignés (mmap-ables sans copie)
+STORAGE_TYPES = ('float32', 'float16', 'pq')
+_EMBEDDINGS_MAGIC = b'FMFEMB\0\0'
+_EMBEDDINGS_VERSION = 1
+# magic, version, stockage, dimension, nombre de vecteurs, octets par vecteur, bits par code PQ, début des vecteurs
+_EMBEDDINGS_HEADER = struct.Struct('<8sHHIQIIQ')
+_EMBEDDINGS_HEADER_SIZE = 64
+
+
+class PQEmbeddings:
+    """Embeddings codés PQ (mappés en mémoire), décodés en float32 seulement quand on les lit."""
+
+    dtype = np.dtype('float32')
+    ndim = 2
+
+    def __init__(self, pq, codes):
+        self.pq = pq
+        self.codes = codes
+
+    @classmethod
+    def encode(cls, embeddings_array):
+        """Entraîne un dictionnaire PQ (PQ_M octets par visage) sur un échantillon et code les embeddings."""
+        embeddings_array = np.ascontiguousarray(np.atleast_2d(embeddings_array), dtype='float32')
+        pq = faiss.ProductQuantizer(embeddings_array.shape[1], PQ_M, 8)
+        pq.train(_train_sample(embeddings_array, 256 * 256))
+        return cls(pq, pq.compute_codes(embeddings_array))
+
+    def flat_index(self):
+        """IndexPQ (produit scalaire) sur le même dictionnaire et les mêmes codes : rien n'est réentraîné ni recodé."""
+        index = faiss.IndexPQ(self.pq.d, self.pq.M, self.pq.nbits, faiss.METRIC_INNER_PRODUCT)
+        index.pq = self.pq
+        index.is_trained = True
+        faiss.copy_array_to_vector(np.ascontiguousarray(self.codes).ravel(), index.codes)
+        index.ntotal = len(self.codes)
+        return index
+
+    @property
+    def shape(self):
+        return len(self.codes), self.pq.d
+
+    @property
+    def size(self):
+        return len(self.codes) * self.pq.d
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        codes = np.ascontiguousarray(self.codes[key])
+        if codes.ndim == 1:
+            return self.pq.decode(codes[None])[0]
+        if not len(codes):
+            return np.zeros((0, self.pq.d), dtype='float32')
+        return self.pq.decode(codes)
+
+    def __array__(self, dtype=None, copy=None):
+        decoded = self[:]
+        return decoded if dtype is None else decoded.astype(dtype)
+
+    def extend(self, keep, new_embeddings):
+        """Nouveaux PQEmbeddings avec le même dictionnaire : codes des lignes `keep` recopiés, puis codes de
+        `new_embeddings`. Aucun vecteur n'est décodé puis recodé, l'erreur de quantification ne se cumule pas."""
+        new_embeddings = np.ascontiguousarray(np.atleast_2d(new_embeddings), dtype='float32')
+        new_codes = (self.pq.compute_codes(new_embeddings) if len(new_embeddings)
+                     else np.zeros((0, self.codes.shape[1]), dtype=np.uint8))
+        return PQEmbeddings(self.pq, np.concatenate([self.codes[keep], new_codes]))
+
+
+def write_embeddings(path, embeddings_array, storage='float16'):
+    """Écrit les embeddings normalisés au format EMBEDDINGS_FILE.
+
+    storage : 'float32', 'float16' (moitié de la taille, écart de similarité ~1e-3) ou 'pq' (PQ_M octets
+    par visage, 32x plus petit que float32, pour les très gros événements). Le PQ demande assez de visages
+    pour entraîner ses 256 centroïdes par sous-espace : en dessous, float16 est utilisé.
+    Des PQEmbeddings écrits en 'pq' gardent leur dictionnaire et leurs codes, sans réentraînement
+    (voir `_apply_changes`).
+    Retourne le stockage effectivement utilisé.
+    """
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Stockage inconnu : {storage} (choix : {', '.join(STORAGE_TYPES)})")
+    pq = None
+    if isinstance(embeddings_array, PQEmbeddings) and storage == 'pq':
+        pq, data = embeddings_array.pq, np.ascontiguousarray(embeddings_array.codes)
+        n, d = embeddings_array.shape
+    else:
+        embeddings_array = np.ascontiguousarray(np.atleast_2d(embeddings_array), dtype='float32')
+        n, d = embeddings_array.shape
+        if storage == 'pq' and n < 256 * MIN_POINTS_PER_CENTROID:
+            storage = 'float16'
+        if storage == 'pq':
+            encoded = PQEmbeddings.encode(embeddings_array)
+            pq, data = encoded.pq, encoded.codes
+        else:
+            data = embeddings_array.astype(storage)
+    centroids = np.zeros(0, dtype='float32') if pq is None else faiss.vector_to_array(pq.centroids).astype('float32')
+    nbits = 0 if pq is None else pq.nbits
+    code_size = pq.code_size if pq is not None else np.dtype(storage).itemsize * d
+    data_offset = _EMBEDDINGS_HEADER_SIZE + centroids.nbytes
+    header = _EMBEDDINGS_HEADER.pack(_EMBEDDINGS_MAGIC, _EMBEDDINGS_VERSION, STORAGE_TYPES.index(storage),
+                                     d, n, code_size, nbits, data_offset)
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(header.ljust(_EMBEDDINGS_HEADER_SIZE, b'\0'))
+            f.write(centroids.tobytes())
+            f.write(np.ascontiguousarray(data).tobytes())
+    _atomic_write(path, write)
+    return storage
+
+
+def read_embeddings(path, mmap=False):
+    """Lit un fichier écrit par `write_embeddings` : tableau (n, d) float32/float16, ou PQEmbeddings.
+
+    Avec mmap=True les vecteurs restent sur disque et ne sont pas copiés ni décompressés.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(_EMBEDDINGS_HEADER_SIZE)
+    if len(header) < _EMBEDDINGS_HEADER.size or header[:8] != _EMBEDDINGS_MAGIC:
+        raise ValueError(f"{path} n'est pas un fichier d'embeddings")
+    _, version, storage_code, d, n, code_size, nbits, data_offset = _EMBEDDINGS_HEADER.unpack_from(header)
+    if version > _EMBEDDINGS_VERSION:
+        raise ValueError(f"{path} : format d'embeddings {version} non supporté (version {_EMBEDDINGS_VERSION} max)")
+    raw = np.memmap(path, dtype=np.uint8, mode='r') if mmap else np.fromfile(path, dtype=np.uint8)
+    data = raw[data_offset:data_offset + n * code_size]
+    storage = STORAGE_TYPES[storage_code]
+    if storage == 'pq':
+        pq = faiss.ProductQuantizer(d, code_size * 8 // nbits, nbits)
+        faiss.copy_array_to_vector(np.array(raw[_EMBEDDINGS_HEADER_SIZE:data_offset]).view('float32'), pq.centroids)
+        return PQEmbeddings(pq, data.reshape(n, code_size))
+    return data.view(storage).reshape(n, d)
+
+
+def save_index(embeddings_array, image_paths, num_faces_per_image, output_folder, data_dir=DATA_DIR,
+               manifest=None, index=None, index_params=None, bboxes=None, storage=None):
+    """Sauvegarde l'index FAISS sérialisé, les embeddings, la table des photos, les bboxes et la métadata.
+
+    Les embeddings sont écrits au format `write_embeddings` (storage, float16 par défaut) et chaque visage
+    référence sa photo par un entier (photo_ids.npy) dans la table des chemins (photos.npy) : tout est
+    mappable en mémoire, sans décompression au chargement.
+    `index` évite de reconstruire l'index quand l'appelant l'a déjà mis à jour (voir `update_embeddings`) ;
+    sinon il est construit avec `index_params` (voir `build_faiss_index`). index_params et storage sont
+    conservés dans la métadata.
+
+    Le fichier de version est écrit en dernier : les processus qui servent des recherches
+    rechargent l'index quand il change (voir `get_index`).
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    storage = storage or 'float16'
+
+    def write_npy(array):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+        return write
+
+    vectors = embeddings_array
+    if (storage == 'pq' and not isinstance(embeddings_array, PQEmbeddings)
+            and len(embeddings_array) >= 256 * MIN_POINTS_PER_CENTROID):
+        # Codé une fois ici : le fichier d'embeddings et l'index flat partagent dictionnaire et codes
+        embeddings_array = PQEmbeddings.encode(embeddings_array)
+    written_storage = write_embeddings(os.path.join(data_dir, EMBEDDINGS_FILE), embeddings_array, storage=storage)
+    photo_paths, photo_ids = np.unique(np.asarray(image_paths, dtype=str), return_inverse=True)
+    _atomic_write(os.path.join(data_dir, PHOTO_IDS_FILE), write_npy(photo_ids.astype('int32')))
+    _atomic_write(os.path.join(data_dir, PHOTOS_FILE), write_npy(photo_paths))
+    if bboxes is None:
+        bboxes = np.full((len(embeddings_array), 4), np.nan, dtype='float32')
+    _atomic_write(os.path.join(data_dir, BBOXES_FILE), write_npy(np.asarray(bboxes, dtype='float32')))
+
+    def write_meta(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'format': DATA_FORMAT, 'num_faces_per_image': num_faces_per_image,
+                         'output_folder': output_folder, 'manifest': manifest or {},
+                         'index_params': index_params or {}, 'storage': storage}, f)
+    _atomic_write(os.path.join(data_dir, META_FILE), write_meta)
+    for name in (V1_EMBEDDINGS_FILE, V1_PATHS_FILE, LEGACY_EMBEDDINGS_FILE):
+        if os.path.exists(os.path.join(data_dir, name)):
+            os.remove(os.path.join(data_dir, name))
+
+    index_path = os.path.join(data_dir, INDEX_FILE)
+    if len(embeddings_array):
+        if index is None and isinstance(embeddings_array, PQEmbeddings) and \
+                (index_params or {}).get('index_type', 'flat') == 'flat':
+            index = embeddings_array.flat_index()
+        elif index is None:
+            index = build_faiss_index(np.asarray(vectors, dtype='float32'), storage=written_storage,
+                                      **(index_params or {}))
+        _atomic_write(index_path, lambda tmp_path: faiss.write_index(index, tmp_path))
+    elif os.path.exists(index_path):
+        os.remove(index_path)
+
+    def write_version(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write(str(time.time_ns()))
+    _atomic_write(os.path.join(data_dir, VERSION_FILE), write_version)
+
+
+def load_data(data_dir=DATA_DIR, mmap=False):
+    """Charge le dossier de données : (embeddings, photo_ids par visage, table des chemins, métadata).
+
+    Avec mmap=True les tableaux sont mappés en mémoire au lieu d'être lus entièrement.
+    Les anciens formats (un chemin par visage dans `image_paths.npy`, ou `embeddings.npz` + pickle) restent lisibles.
+    """
+    meta = load_meta(data_dir)
+    mmap_mode = 'r' if mmap else None
+    try:
+        if meta.get('format', 1) >= 2:
+            embeddings_array = read_embeddings(os.path.join(data_dir, EMBEDDINGS_FILE), mmap=mmap)
+            photo_ids = np.load(os.path.join(data_dir, PHOTO_IDS_FILE), mmap_mode=mmap_mode)
+            photo_paths = np.load(os.path.join(data_dir, PHOTOS_FILE), mmap_mode=mmap_mode)
+            return embeddings_array, photo_ids, photo_paths, meta
+        if 'image_paths' in meta:
+            embeddings_array = np.load(os.path.join(data_dir, LEGACY_EMBEDDINGS_FILE))['embeddings']
+            image_paths = np.array(meta['image_paths'], dtype=str)
+        else:
+            embeddings_array = np.load(os.path.join(data_dir, V1_EMBEDDINGS_FILE), mmap_mode=mmap_mode)
+            image_paths = np.load(os.path.join(data_dir, V1_PATHS_FILE))
+    except FileNotFoundError:
+        raise FileNotFoundError("Les fichiers d'embeddings n'existent pas. Exécutez d'abord `build`.")
+    photo_paths, photo_ids = np.unique(image_paths, return_inverse=True)
+    return embeddings_array, photo_ids, photo_paths, meta
+
+
+def load_embeddings(data_dir=DATA_DIR, mmap=False):
+    """Charge embeddings et métadata depuis le disque. Retourne la même structure que build_embeddings()
+
+    image_paths est reconstruit visage par visage depuis la table des photos (voir `load_data`).
+    """
+    embeddings_array, photo_ids, photo_paths, meta = load_data(data_dir, mmap=mmap)
+    image_paths = photo_paths[np.asarray(photo_ids)] if len(photo_ids) else np.empty(0, dtype=str)
+    return embeddings_array, image_paths, meta['num_faces_per_image'], meta.get('output_folder', 'data/similar_images')
+
+
+def load_bboxes(data_dir=DATA_DIR, mmap=False):
+    """Bboxes (x1, y1, x2, y2) par visage, NaN pour les dossiers construits avant leur enregistrement."""
+    bboxes_path = os.path.join(data_dir, BBOXES_FILE)
+    if os.path.exists(bboxes_path):
+        return np.load(bboxes_path, mmap_mode='r' if mmap else None)
+    photo_ids = load_data(data_dir, mmap=True)[1]
+    return np.full((len(photo_ids), 4), np.nan, dtype='float32')
+
+
+def load_meta(data_dir=DATA_DIR):
+    """Métadata brute écrite par `save_index`."""
+    meta_path = os.path.join(data_dir, META_FILE)
+    if not os.path.exists(meta_path):
         raise FileNotFoundError("Les fichiers d'embeddings n'existent pas. Exécutez d'abord `build`.")
-    data = np.load('data/embeddings.npz')
-    embeddings_array = data['embeddings']
-    with open('data/meta.pkl', 'rb') as f:
-        meta = pickle.load(f)
-    return embeddings_array, meta['image_paths'], meta['num_faces_per_image'], meta.get('output_folder', 'data/similar_images')
+    with open(meta_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_faiss_index(data_dir=DATA_DIR):
+    """Lit l'index sérialisé en mémoire (modifiable), ou None s'il n'existe pas ou date d'avant le produit scalaire."""
+    index_path = os.path.join(data_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+    index = faiss.read_index(index_path)
+    if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        return None
+    return index
+
+
+def read_index_mmap(index_path):
+    """Lit un index sérialisé en lecture seule, ses vecteurs mappés en mémoire plutôt que copiés.
+
+    IO_FLAG_MMAP ne mappe que les listes inversées des index IVF : un index flat (IndexFlatIP, et les
+    IndexFlatCodes en général) serait lu en entier. Les index IVF (code FAISS 'Iw..') sont donc lus avec
+    IO_FLAG_MMAP, les autres (flat, SQ, PQ, HNSW) avec IO_FLAG_MMAP_IFC.
+    """
+    with open(index_path, 'rb') as f:
+        fourcc = f.read(4)
+    flag = faiss.IO_FLAG_MMAP if fourcc.startswith(b'Iw') else faiss.IO_FLAG_MMAP_IFC
+    return faiss.read_index(index_path, flag | faiss.IO_FLAG_READ_ONLY)
+
+
+def normalize_embeddings(embeddings):
+    """Normalise les embeddings (L2) : le produit scalaire entre deux vecteurs devient leur similarité cosinus."""
+    embeddings = np.array(np.atleast_2d(embeddings), dtype='float32')
+    if embeddings.size:
+        faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+INDEX_TYPES = ('flat', 'ivf', 'ivfpq', 'hnsw')
+# Points d'entraînement minimum par centroïde (en dessous faiss avertit et le k-means est peu fiable)
+MIN_POINTS_PER_CENTROID = 39
+PQ_M = 64             # sous-quantifieurs IVF-PQ : 512 / 64 = 8 dimensions par code d'un octet
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+
+
+def _train_sample(embeddings_array, size, seed=0):
+    if len(embeddings_array) <= size:
+        return embeddings_array
+    rng = np.random.default_rng(seed)
+    return embeddings_array[np.sort(rng.choice(len(embeddings_array), size, replace=False))]
 
 
-def build_faiss_index(embeddings_array):
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Applique les paramètres de recherche (nprobe pour IVF, efSearch pour HNSW) ; ignorés par les autres types."""
+    if nprobe is not None:
+        try:
+            faiss.extract_index_ivf(index).nprobe = nprobe
+        except RuntimeError:
+            pass
+    if ef_search is not None and hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def build_faiss_index(embeddings_array, index_type='flat', nlist=None, nprobe=None, ef_search=None, storage=None):
+    """Index produit scalaire sur les embeddings normalisés : les scores de recherche sont des similarités cosinus.
+
+    index_type :
+        'flat'  recherche exhaustive, linéaire en nombre de visages. Les vecteurs y sont stockés selon
+                storage (voir `write_embeddings`) : float32 exacts (IndexFlatIP, par défaut), float16
+                (IndexScalarQuantizer, moitié de la taille) ou codes PQ (IndexPQ, PQ_M octets par visage,
+                similarités approchées ; float16 avec trop peu de visages pour entraîner le PQ).
+        'ivf'   IVF-Flat : nlist listes (défaut 4 * sqrt(n)), nprobe listes visitées par recherche.
+        'ivfpq' IVF-PQ : comme 'ivf' avec des codes de PQ_M octets par visage au lieu de 2 Ko.
+        'hnsw'  graphe HNSW, ef_search candidats explorés par recherche.
+    Les index IVF sont entraînés sur un échantillon. Avec trop peu de visages pour entraîner,
+    l'index est construit en 'flat'. nprobe / ef_search sont sérialisés avec l'index.
+    """
     if embeddings_array.size == 0:
         raise ValueError('Pas d\'embeddings pour construire l\'index')
-    d = embeddings_array.shape[1]
-    index = faiss.IndexFlatL2(d)
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Type d'index inconnu : {index_type} (choix : {', '.join(INDEX_TYPES)})")
+    embeddings_array = normalize_embeddings(embeddings_array)
+    n, d = embeddings_array.shape
+
+    if index_type in ('ivf', 'ivfpq'):
+        nlist = nlist or int(4 * np.sqrt(n))
+        nlist = min(nlist, n // MIN_POINTS_PER_CENTROID)
+        if index_type == 'ivfpq' and n < MIN_POINTS_PER_CENTROID * 256:
+            print(f"Trop peu de visages ({n}) pour entraîner IVF-PQ, index IVF-Flat utilisé")
+            index_type = 'ivf'
+        if nlist < 2:
+            print(f"Trop peu de visages ({n}) pour un index IVF, index flat utilisé")
+            index_type = 'flat'
+
+    if index_type == 'flat' and storage == 'pq' and n < MIN_POINTS_PER_CENTROID * 256:
+        storage = 'float16'
+    if index_type == 'flat' and storage == 'float16':
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == 'flat' and storage == 'pq':
+        index = faiss.IndexPQ(d, PQ_M, 8, faiss.METRIC_INNER_PRODUCT)
+        index.train(_train_sample(embeddings_array, 256 * 256))
+    elif index_type == 'flat':
+        index = faiss.IndexFlatIP(d)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        set_search_params(index, ef_search=ef_search or 128)
+    else:
+        quantizer = faiss.IndexFlatIP(d)
+        if index_type == 'ivf':
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+            train_size = MIN_POINTS_PER_CENTROID * nlist * 4
+        else:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, PQ_M, 8, faiss.METRIC_INNER_PRODUCT)
+            train_size = MIN_POINTS_PER_CENTROID * max(nlist, 256) * 4
+        index.train(_train_sample(embeddings_array, train_size))
+        set_search_params(index, nprobe=nprobe or min(nlist, 16))
     index.add(embeddings_array)
     return index
 
 
-def search_image(target_image_path, k=5, ctx_id=-1, copy_results=True):
-    """Charge les embeddings, encode l'image cible, et recherche les k plus proches.
+def describe_index(index):
+    """Type et paramètres de recherche effectifs d'un index, pour affichage."""
+    if index is None:
+        return 'vide'
+    if hasattr(index, 'hnsw'):
+        return f"HNSW (efSearch={index.hnsw.efSearch})"
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        if isinstance(index, faiss.IndexScalarQuantizer):
+            return 'Flat (float16)'
+        if isinstance(index, faiss.IndexPQ):
+            return f"Flat (PQ, {index.pq.M} octets)"
+        return 'Flat'
+    kind = 'IVF-PQ' if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else 'IVF-Flat'
+    return f"{kind} (nlist={ivf.nlist}, nprobe={ivf.nprobe})"
+
+
+def event_data_dir(event_id, data_dir=DATA_DIR):
+    """Dossier du shard d'un événement. event_id ne peut contenir que lettres, chiffres, '-' et '_'."""
+    event_id = str(event_id)
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', event_id):
+        raise ValueError(f"Identifiant d'événement invalide : {event_id!r}")
+    return os.path.join(data_dir, EVENTS_DIR, event_id)
+
+
+def data_version(data_dir=DATA_DIR):
+    """Jeton identifiant la version des visages sur disque (mtime du fichier de version ou, à défaut, des anciens fichiers)."""
+    for name in (VERSION_FILE, LEGACY_EMBEDDINGS_FILE):
+        try:
+            return os.stat(os.path.join(data_dir, name)).st_mtime_ns
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError("Les fichiers d'embeddings n'existent pas. Exécutez d'abord `build`.")
+
+
+def index_version(data_dir=DATA_DIR):
+    """Jeton identifiant ce que sert `get_index` : version des visages et des clusters (voir `cluster_faces`)."""
+    version = data_version(data_dir)
+    try:
+        return version, os.stat(os.path.join(data_dir, CLUSTERS_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        return version, None
 
-    Copie les images similaires dans le dossier `output_folder` si copy_results=True.
-    Retourne une liste de tuples (similar_image_path, distance)
+
+class FaceIndex:
+    """Index FAISS et métadata d'un dossier de données, chargés une seule fois (mmap) puis partagés entre recherches.
+
+    Un objet FaceIndex ne change jamais après chargement : `get_index` en crée un nouveau
+    quand la version sur disque change, les recherches en cours gardent l'ancien.
     """
-    embeddings_array, image_paths, num_faces_per_image, output_folder = load_embeddings()
-    if embeddings_array.size == 0:
-        raise ValueError('Les embeddings sont vides. Exécutez build avant search.')
 
-    index = build_faiss_index(embeddings_array)
+    def __init__(self, index, embeddings_array, photo_ids, photo_paths, num_faces_per_image, output_folder,
+                 version=None, bboxes=None):
+        self.index = index
+        self.embeddings_array = embeddings_array
+        self.photo_ids = photo_ids
+        self.photo_paths = photo_paths
+        self.bboxes = bboxes
+        self.num_faces_per_image = num_faces_per_image
+        self.output_folder = output_folder
+        self.version = version
+        self.nbytes = 0
+        self.clusters = None
+        self.data_dir = None
+
+    @classmethod
+    def load(cls, data_dir=DATA_DIR):
+        version = index_version(data_dir)
+        embeddings_array, photo_ids, photo_paths, meta = load_data(data_dir, mmap=True)
+        index_path = os.path.join(data_dir, INDEX_FILE)
+        index = None
+        if os.path.exists(index_path):
+            index = read_index_mmap(index_path)
+        if len(embeddings_array) and (index is None or index.metric_type != faiss.METRIC_INNER_PRODUCT):
+            # Ancien format (sans index sérialisé, ou index L2 sur embeddings bruts) : reconstruit en mémoire
+            index = build_faiss_index(np.asarray(embeddings_array, dtype='float32'))
+        face_index = cls(index, embeddings_array, photo_ids, photo_paths, meta['num_faces_per_image'],
+                         meta.get('output_folder', 'data/similar_images'), version=version,
+                         bboxes=load_bboxes(data_dir, mmap=True))
+        # Taille des fichiers mappés, plus l'index reconstruit en mémoire pour l'ancien format
+        face_index.nbytes = sum(os.path.getsize(os.path.join(data_dir, name))
+                                for name in (INDEX_FILE, EMBEDDINGS_FILE, PHOTO_IDS_FILE, PHOTOS_FILE, BBOXES_FILE,
+                                             V1_EMBEDDINGS_FILE, V1_PATHS_FILE)
+                                if os.path.exists(os.path.join(data_dir, name)))
+        if not os.path.exists(index_path):
+            face_index.nbytes += 2 * len(embeddings_array) * 512 * 4
+        face_index.clusters = load_clusters(data_dir)
+        face_index.data_dir = data_dir
+        return face_index
+
+    def thumbnail(self, photo_path):
+        """Miniature de la photo (voir `sync_thumbnails`), ou None si elle n'a pas été générée."""
+        if self.data_dir is None:
+            return None
+        path = thumbnail_path(self.data_dir, photo_path)
+        return path if os.path.exists(path) else None
+
+    @property
+    def image_paths(self):
+        """Chemin de la photo de chaque visage."""
+        return self.photo_paths[np.asarray(self.photo_ids)]
+
+    @property
+    def ntotal(self):
+        return 0 if self.index is None else self.index.ntotal
+
+    def _query(self, query_embeddings):
+        if self.ntotal == 0:
+            raise ValueError('Les embeddings sont vides. Exécutez build avant search.')
+        return normalize_embeddings(query_embeddings)
+
+    def search(self, query_embeddings, k):
+        """Recherche les k plus proches voisins. Retourne (similarités cosinus, indices) comme `faiss.Index.search`."""
+        return self.index.search(self._query(query_embeddings), min(k, self.ntotal))
+
+    def range_search(self, query_embeddings, threshold):
+        """Retourne, pour chaque requête, tous les visages de similarité cosinus > threshold.
+
+        Retourne une liste de tuples (similarités, indices) triés par similarité décroissante, un par requête.
+        """
+        lims, similarities, indices = self.index.range_search(self._query(query_embeddings), threshold)
+        results = []
+        for q in range(len(lims) - 1):
+            q_sims, q_ids = similarities[lims[q]:lims[q + 1]], indices[lims[q]:lims[q + 1]]
+            order = np.argsort(-q_sims, kind='stable')
+            results.append((q_sims[order], q_ids[order]))
+        return results
+
+    def group_by_photo(self, similarities, indices, query_ids=None, n_queries=1, mode='any', offset=0, limit=None):
+        """Regroupe des visages trouvés par photo, triées par similarité décroissante.
+
+        query_ids donne, pour chaque visage trouvé, l'indice de la requête (visage cherché) qui l'a trouvé.
+        mode='any' garde les photos trouvées par au moins une requête (score : meilleure similarité) ;
+        mode='all' seulement celles trouvées par toutes les requêtes (score : la plus faible des meilleures
+        similarités par requête).
+        Pour chaque photo : score, indice et bbox du meilleur visage, nombre de visages trouvés, requêtes trouvées
+        et nombre total de visages de la photo ; pour une vidéo, photo_path est <vidéo>#t=<secondes> et
+        timestamp l'instant où la piste de visage commence. Retourne (nombre total de photos, page [offset, offset+limit)).
+        """
+        if mode not in ('any', 'all'):
+            raise ValueError(f"Mode inconnu : {mode} (choix : any, all)")
+        similarities, indices = np.asarray(similarities).ravel(), np.asarray(indices).ravel()
+        query_ids = np.zeros(len(indices), dtype='int64') if query_ids is None else np.asarray(query_ids).ravel()
+        valid = indices >= 0
+        similarities, indices, query_ids = similarities[valid], indices[valid], query_ids[valid]
+        photo_ids, photo_of_hit = np.unique(np.asarray(self.photo_ids[indices]), return_inverse=True)
+        photo_paths = self.photo_paths[photo_ids] if len(photo_ids) else np.empty(0, dtype=str)
 
-    target_embs = get_face_embeddings(target_image_path, ctx_id=ctx_id)
+        # Meilleure similarité de chaque requête dans chaque photo
+        per_query = np.full((len(photo_paths), n_queries), -np.inf, dtype='float32')
+        np.maximum.at(per_query, (photo_of_hit, query_ids), similarities)
+        found = np.isfinite(per_query)
+        if mode == 'all':
+            scores = np.where(found.all(axis=1), per_query.min(axis=1), -np.inf)
+        else:
+            scores = per_query.max(axis=1)
+        # Meilleur visage de chaque photo : première occurrence dans l'ordre décroissant
+        order = np.argsort(-similarities, kind='stable')
+        _, best = np.unique(photo_of_hit[order], return_index=True)
+        best_hit = order[best]
+        # Visages distincts trouvés par photo (un visage peut correspondre à plusieurs requêtes)
+        unique_faces = np.unique(np.stack([photo_of_hit, indices]), axis=1) if len(indices) else np.empty((2, 0), int)
+        matched_faces = np.bincount(unique_faces[0], minlength=len(photo_paths))
+
+        ranking = np.argsort(-scores, kind='stable')
+        ranking = ranking[np.isfinite(scores[ranking])]
+        end = None if limit is None else offset + limit
+        photos = []
+        for photo in ranking[offset:end]:
+            path = str(photo_paths[photo])
+            face = int(indices[best_hit[photo]])
+            bbox = None if self.bboxes is None or np.isnan(self.bboxes[face]).any() else self.bboxes[face].tolist()
+            photos.append({
+                'photo_path': path,
+                'similarity': float(scores[photo]),
+                'face_index': face,
+                'bbox': bbox,
+                'matched_faces': int(matched_faces[photo]),
+                'matched_queries': np.flatnonzero(found[photo]).tolist(),
+                'num_faces': self.num_faces_per_image.get(path),
+                'thumbnail': self.thumbnail(path),
+                'timestamp': split_media_key(path)[1],
+            })
+        return len(ranking), photos
+
+    def search_photos(self, query_embeddings, k=None, threshold=None, mode='any', offset=0, limit=None,
+                      use_clusters=False):
+        """Recherche un ou plusieurs visages et retourne les photos correspondantes, une entrée par photo.
+
+        Toutes les requêtes (par exemple tous les visages d'un selfie de groupe) passent dans un seul appel
+        à l'index. Avec threshold, les visages de similarité > threshold ; sinon les k plus proches de chaque
+        requête. mode : 'any' (photos de l'un d'entre nous) ou 'all' (photos de nous tous), voir `group_by_photo`.
+        Avec use_clusters et des clusters à jour, voir `search_clusters`.
+        Retourne {'total': nombre de photos, 'photos': page demandée}.
+        """
+        query = self._query(query_embeddings)
+        if use_clusters and self.clusters is not None:
+            similarities, indices, query_ids = self.search_clusters(query, threshold=threshold, k=k)
+        elif threshold is None:
+            similarities, indices = self.index.search(query, min(k or 10, self.ntotal))
+            query_ids = np.repeat(np.arange(len(query)), indices.shape[1])
+        else:
+            lims, similarities, indices = self.index.range_search(query, threshold)
+            query_ids = np.repeat(np.arange(len(query)), np.diff(lims).astype('int64'))
+        total, photos = self.group_by_photo(similarities, indices, query_ids=query_ids, n_queries=len(query),
+                                            mode=mode, offset=offset, limit=limit)
+        return {'total': total, 'photos': photos}
+
+    def cluster_members(self, cluster):
+        """Indices des visages d'un cluster."""
+        starts = self.clusters['starts']
+        return self.clusters['members'][starts[cluster]:starts[cluster + 1]]
+
+    def search_clusters(self, query_embeddings, threshold=None, k=None):
+        """Compare les requêtes aux centroïdes des identités (quelques centaines) au lieu de chaque visage.
+
+        Une requête retient les clusters de centroïde à similarité > threshold et tous leurs visages, même
+        ceux trop différents du selfie pour être trouvés seuls (profil, flou) : le résultat est plus complet
+        qu'une recherche visage par visage. Sans threshold, seul le cluster le plus proche est retenu, et de
+        ses membres les k (10 par défaut) plus similaires à la requête, comme pour la recherche par visage.
+        Retourne (similarités, indices, query_ids) des visages retenus, pour `group_by_photo` ; la similarité
+        d'un visage est celle avec la requête, calculée sur les seuls membres.
+        """
+        query = self._query(query_embeddings)
+        centroid_similarities = query @ self.clusters['centroids'].T
+        similarities, indices, query_ids = [], [], []
+        for query_id, row in enumerate(centroid_similarities):
+            if threshold is None:
+                matched = [int(np.argmax(row))]
+            else:
+                matched = np.flatnonzero(row > threshold)
+            if not len(matched):
+                continue
+            members = np.sort(np.concatenate([self.cluster_members(cluster) for cluster in matched]))
+            embeddings = np.asarray(self.embeddings_array[members], dtype='float32')
+            member_similarities = normalize_embeddings(embeddings) @ query[query_id]
+            if threshold is None:
+                best = np.argsort(-member_similarities, kind='stable')[:k or 10]
+                members, member_similarities = members[best], member_similarities[best]
+            similarities.append(member_similarities)
+            indices.append(members)
+            query_ids.append(np.full(len(members), query_id))
+        if not indices:
+            return np.empty(0, dtype='float32'), np.empty(0, dtype='int64'), np.empty(0, dtype='int64')
+        return np.concatenate(similarities), np.concatenate(indices), np.concatenate(query_ids)
+
+    def people(self, min_size=2, offset=0, limit=None):
+        """Galerie « personnes de l'événement » : un cluster par identité, du plus photographié au moins.
+
+        Pour chaque cluster d'au moins min_size visages : nombre de visages et de photos, et le visage le plus
+        proche du centroïde (photo et bbox) comme portrait. Retourne (nombre total de clusters, page).
+        """
+        if self.clusters is None:
+            raise ValueError("Pas de clusters à jour : exécutez `cluster` après build / update.")
+        sizes = np.diff(self.clusters['starts'])
+        photo_ids = np.asarray(self.photo_ids)
+        photos_per_cluster = np.array([len(np.unique(photo_ids[self.cluster_members(c)])) for c in range(len(sizes))],
+                                      dtype='int64').reshape(-1)
+        ranking = [c for c in np.lexsort((-sizes, -photos_per_cluster)) if sizes[c] >= min_size]
+        end = None if limit is None else offset + limit
+        people = []
+        for cluster in ranking[offset:end]:
+            members = self.cluster_members(cluster)
+            embeddings = normalize_embeddings(np.asarray(self.embeddings_array[members], dtype='float32'))
+            face = int(members[np.argmax(embeddings @ self.clusters['centroids'][cluster])])
+            bbox = None if self.bboxes is None or np.isnan(self.bboxes[face]).any() else self.bboxes[face].tolist()
+            people.append({
+                'cluster': int(cluster),
+                'faces': int(sizes[cluster]),
+                'photos': int(photos_per_cluster[cluster]),
+                'photo_path': str(self.photo_paths[photo_ids[face]]),
+                'face_index': face,
+                'bbox': bbox,
+                'thumbnail': self.thumbnail(self.photo_paths[photo_ids[face]]),
+            })
+        return len(ranking), people
+
+
+# Index chargés, du moins au plus récemment utilisé
+_INDEXES = OrderedDict()
+_INDEXES_LOCK = threading.Lock()
+# Un verrou de chargement par dossier de données (voir `get_index`)
+_LOAD_LOCKS = {}
+
+
+def _cached_index(data_dir, version):
+    """Index en cache pour `data_dir` s'il est à jour (marqué récemment utilisé), sinon None."""
+    with _INDEXES_LOCK:
+        face_index = _INDEXES.get(data_dir)
+        if face_index is None or face_index.version != version:
+            return None
+        _INDEXES.move_to_end(data_dir)
+        return face_index
+
+
+def get_index(data_dir=DATA_DIR):
+    """Retourne l'index du processus pour `data_dir`, rechargé seulement si la version sur disque a changé.
+
+    Les index restent en cache (LRU) tant que leur taille totale tient dans INDEX_CACHE_BYTES : les shards
+    des événements actifs restent chargés, les événements froids ou archivés sont chargés à la demande.
+    Un shard se charge hors du verrou global, sous un verrou propre à `data_dir` : les recherches sur les
+    autres shards ne l'attendent pas, et des requêtes simultanées sur le même shard ne le chargent qu'une fois.
+    """
+    version = index_version(data_dir)
+    face_index = _cached_index(data_dir, version)
+    if face_index is not None:
+        return face_index
+    with _INDEXES_LOCK:
+        load_lock = _LOAD_LOCKS.setdefault(data_dir, threading.Lock())
+    with load_lock:
+        # Chargé par une autre requête pendant l'attente du verrou
+        face_index = _cached_index(data_dir, version)
+        if face_index is not None:
+            return face_index
+        face_index = FaceIndex.load(data_dir)
+        with _INDEXES_LOCK:
+            _INDEXES[data_dir] = face_index
+            _INDEXES.move_to_end(data_dir)
+            # L'index demandé n'est jamais évincé, même s'il dépasse le budget à lui seul
+            while len(_INDEXES) > 1 and sum(cached.nbytes for cached in _INDEXES.values()) > INDEX_CACHE_BYTES:
+                _INDEXES.popitem(last=False)
+    return face_index
+
+
+def index_cache_stats():
+    """Nombre d'index chargés par `get_index` et leur taille totale (octets)."""
+    with _INDEXES_LOCK:
+        return {'indexes': len(_INDEXES), 'bytes': sum(cached.nbytes for cached in _INDEXES.values())}
+
+
+def search_image(target_image_path, k=5, ctx_id=-1, data_dir=DATA_DIR, threshold=None, all_faces=False, mode='any',
+                 use_clusters=False):
+    """Encode l'image cible et recherche les photos similaires dans l'index partagé (voir `get_index`).
+
+    target_image_path peut être une liste d'images (plusieurs selfies). Par défaut seul le premier visage
+    de chaque image est cherché ; avec all_faces=True, tous les visages (selfie de groupe), en une seule
+    recherche. mode : 'any' ou 'all' (voir `FaceIndex.group_by_photo`). use_clusters : voir `FaceIndex.search_clusters`.
+    Sans threshold, retourne les photos des k visages les plus proches ; avec threshold, toutes les photos
+    contenant un visage de similarité cosinus > threshold. Chaque photo n'apparaît qu'une fois.
+    Aucun fichier n'est lu ni copié : voir `deliver_results` pour livrer les photos trouvées.
+    Retourne une liste de tuples (similar_image_path, similarity)
+    """
+    face_index = get_index(data_dir)
+    if face_index.ntotal == 0:
+        raise ValueError('Les embeddings sont vides. Exécutez build avant search.')
+
+    targets = [target_image_path] if isinstance(target_image_path, str) else list(target_image_path)
+    target_embs = []
+    for embs in get_face_embeddings_batch(targets, ctx_id=ctx_id):
+        target_embs.extend(embs if all_faces else embs[:1])
     if len(target_embs) == 0:
         raise Exception("Aucun visage détecté dans l'image cible")
-    target_emb = np.array([target_embs[0]]).astype('float32')
+    target_emb = np.array(target_embs).astype('float32')
 
-    distances, indices = index.search(target_emb, k)
+    photos = face_index.search_photos(target_emb, k=k, threshold=threshold, mode=mode, use_clusters=use_clusters)['photos']
 
-    results = []
-    for i, idx in enumerate(indices[0]):
-        similar_image_path = image_paths[idx]
-        dist = float(distances[0][i])
-        results.append((similar_image_path, dist))
-        if copy_results:
-            os.makedirs(output_folder, exist_ok=True)
+    return [(photo['photo_path'], photo['similarity']) for photo in photos]
+
+
+DELIVERY_MODES = ('hardlink', 'symlink', 'copy', 'manifest')
+
+
+def deliver_results(results, output_folder, mode='hardlink', data_dir=DATA_DIR):
+    """Livre les résultats de `search_image` dans un dossier propre à la requête, créé dans output_folder :
+    des recherches simultanées n'écrivent jamais dans le même dossier.
+
+    mode : 'hardlink' (lien physique, lien symbolique si la photo est sur un autre système de fichiers),
+    'symlink', 'copy' (copie complète des photos) ou 'manifest' (aucun fichier photo).
+    Le dossier contient toujours manifest.json : rang, chemin, similarité, miniature (voir `sync_thumbnails`),
+    instant (vidéos, sinon None) et fichier livré de chaque photo. Les fichiers sont préfixés par le rang, ce qui garde l'ordre et évite
+    les collisions entre photos de même nom. Retourne le chemin du dossier.
+    """
+    if mode not in DELIVERY_MODES:
+        raise ValueError(f"Mode de livraison inconnu : {mode} (attendu : {', '.join(DELIVERY_MODES)})")
+    os.makedirs(output_folder, exist_ok=True)
+    request_dir = tempfile.mkdtemp(prefix=time.strftime('%Y%m%d-%H%M%S-'), dir=output_folder)
+    entries = []
+    for rank, (path, similarity) in enumerate(results, start=1):
+        thumbnail = thumbnail_path(data_dir, path)
+        entry = {'rank': rank, 'photo_path': path, 'similarity': similarity,
+                 'thumbnail': thumbnail if os.path.exists(thumbnail) else None, 'file': None}
+        source, entry['timestamp'] = split_media_key(path)
+        if mode != 'manifest':
+            path = source  # une vidéo est livrée entière, l'instant est dans le manifest
+            target = os.path.join(request_dir, f'{rank:03d}_{os.path.basename(path)}')
             try:
-                shutil.copy(similar_image_path, output_folder)
-            except Exception:
+                if mode == 'copy':
+                    shutil.copy(path, target)
+                elif mode == 'hardlink':
+                    try:
+                        os.link(path, target)
+                    except OSError:
+                        os.symlink(os.path.abspath(path), target)
+                else:
+                    os.symlink(os.path.abspath(path), target)
+                entry['file'] = os.path.basename(target)
+            except OSError:
                 pass
+        entries.append(entry)
+    with open(os.path.join(request_dir, 'manifest.json'), 'w') as f:
+        json.dump(entries, f, indent=2)
+    return request_dir
+
+
+def index_report(data_dir=DATA_DIR, k=10, n_queries=200, nprobes=None, ef_searches=None, seed=0):
+    """Compare l'index sur disque à une recherche exacte (flat) : recall@k et latence par requête.
+
+    Les requêtes sont des embeddings indexés bruités (similarité ~0.7 avec l'original), pour simuler
+    un selfie d'une personne présente. nprobes / ef_searches : valeurs supplémentaires à mesurer.
+    Retourne une liste de dicts {'index', 'recall', 'ms_per_query'}, le flat en premier.
+    """
+    face_index = FaceIndex.load(data_dir)
+    if face_index.ntotal == 0:
+        raise ValueError('Les embeddings sont vides. Exécutez build avant search.')
+    embeddings_array = np.asarray(face_index.embeddings_array, dtype='float32')
+    rng = np.random.default_rng(seed)
+    queries = embeddings_array[rng.choice(len(embeddings_array), min(n_queries, len(embeddings_array)), replace=False)]
+    queries = normalize_embeddings(queries + rng.normal(size=queries.shape).astype('float32') / np.sqrt(queries.shape[1]))
+    k = min(k, face_index.ntotal)
+
+    def measure(index):
+        start = time.perf_counter()
+        _, indices = index.search(queries, k)
+        return indices, (time.perf_counter() - start) * 1000 / len(queries)
+
+    flat = build_faiss_index(embeddings_array)
+    truth, flat_ms = measure(flat)
+    report = [{'index': 'Flat', 'recall': 1.0, 'ms_per_query': flat_ms}]
+
+    settings = [{}]
+    if hasattr(face_index.index, 'hnsw'):
+        settings += [{'ef_search': ef} for ef in ef_searches or []]
+    elif not isinstance(face_index.index, faiss.IndexFlatCodes):
+        settings += [{'nprobe': n} for n in nprobes or []]
+    for params in settings:
+        index = set_search_params(face_index.index, **params)
+        found, ms = measure(index)
+        recall = np.mean([len(np.intersect1d(f, t)) / k for f, t in zip(found, truth)])
+        report.append({'index': describe_index(index), 'recall': float(recall), 'ms_per_query': ms})
+    return report
+
+
+def _face_keys(photo_ids, photo_paths):
+    """Identifiant stable de chaque visage : (chemin de la photo, rang du visage dans la photo).
+
+    Les indices FAISS changent quand des photos sont retirées ; ces clés restent les mêmes pour les photos
+    inchangées (`update_embeddings` et `add_embeddings` conservent l'ordre de leurs visages).
+    """
+    photo_ids = np.asarray(photo_ids)
+    order = np.argsort(photo_ids, kind='stable')
+    starts = np.searchsorted(photo_ids[order], photo_ids[order], side='left')
+    ranks = np.empty(len(photo_ids), dtype='int64')
+    ranks[order] = np.arange(len(photo_ids)) - starts
+    return [(str(photo_paths[photo]), int(rank)) for photo, rank in zip(photo_ids, ranks)]
+
+
+def _find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
 
-    return results
+
+def load_clusters(data_dir=DATA_DIR):
+    """Clusters écrits par `cluster_faces`, ou None s'ils n'existent pas ou datent d'une autre version des visages.
+
+    Ajoute 'members' (indices des visages triés par cluster) et 'starts' (début de chaque cluster dans members).
+    """
+    try:
+        with open(os.path.join(data_dir, CLUSTERS_FILE), 'rb') as f:
+            clusters = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    if clusters['data_version'] != data_version(data_dir):
+        return None
+    labels = clusters['labels']
+    clusters['members'] = np.argsort(labels, kind='stable')
+    clusters['starts'] = np.searchsorted(labels[clusters['members']], np.arange(len(clusters['centroids']) + 1))
+    return clusters
+
+
+def cluster_faces(data_dir=DATA_DIR, threshold=0.5, k=20, full=False, batch_size=8192):
+    """Regroupe les visages indexés par identité et sauvegarde les clusters (CLUSTERS_FILE).
+
+    Graphe de voisinage construit avec l'index FAISS existant : chaque visage est relié à ses k plus proches
+    voisins de similarité > threshold, les composantes connexes forment les identités (k borne l'effet des
+    visages ambigus qui relieraient deux personnes). Incrémental : les visages déjà regroupés gardent leur
+    cluster (retrouvé par `_face_keys`), seuls les visages nouveaux cherchent leurs voisins, et rejoignent un
+    cluster existant ou en forment de nouveaux. full=True reprend tout depuis zéro.
+    Les clusters sont numérotés du plus grand au plus petit ; un visage seul forme son propre cluster.
+    Retourne le nombre de clusters.
+    """
+    face_index = FaceIndex.load(data_dir)
+    n = face_index.ntotal
+    keys = _face_keys(face_index.photo_ids, face_index.photo_paths)
+    labels = np.full(n, -1, dtype='int64')
+    previous = None
+    if not full:
+        try:
+            with open(os.path.join(data_dir, CLUSTERS_FILE), 'rb') as f:
+                previous = pickle.load(f)
+        except FileNotFoundError:
+            pass
+    if previous is not None and previous['threshold'] == threshold and previous['k'] == k:
+        old_labels = dict(zip(previous['keys'], previous['labels'].tolist()))
+        labels = np.array([old_labels.get(key, -1) for key in keys], dtype='int64').reshape(n)
+
+    parent = list(range(n))
+    # Les visages d'un même ancien cluster sont déjà reliés
+    clustered = np.flatnonzero(labels >= 0)
+    first_of_label = {}
+    for face in clustered.tolist():
+        parent[face] = first_of_label.setdefault(int(labels[face]), face)
+    new_faces = np.flatnonzero(labels < 0)
+    for start in range(0, len(new_faces), batch_size):
+        batch = new_faces[start:start + batch_size]
+        query = normalize_embeddings(np.asarray(face_index.embeddings_array[batch], dtype='float32'))
+        similarities, neighbours = face_index.index.search(query, min(k + 1, n))
+        for face, row_similarities, row_neighbours in zip(batch.tolist(), similarities, neighbours):
+            for similarity, neighbour in zip(row_similarities.tolist(), row_neighbours.tolist()):
+                if neighbour < 0 or neighbour == face or similarity <= threshold:
+                    continue
+                root_face, root_neighbour = _find(parent, face), _find(parent, neighbour)
+                if root_face != root_neighbour:
+                    parent[max(root_face, root_neighbour)] = min(root_face, root_neighbour)
+
+    roots = np.array([_find(parent, face) for face in range(n)], dtype='int64').reshape(n)
+    unique_roots, labels, sizes = np.unique(roots, return_inverse=True, return_counts=True)
+    # Renumérote du plus grand cluster au plus petit
+    rank = np.empty(len(unique_roots), dtype='int64')
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(unique_roots))
+    labels = rank[labels].astype('int32')
+    centroids = np.zeros((len(unique_roots), 512), dtype='float32')
+    for start in range(0, n, batch_size):
+        embeddings = normalize_embeddings(np.asarray(face_index.embeddings_array[start:start + batch_size],
+                                                     dtype='float32'))
+        np.add.at(centroids, labels[start:start + batch_size], embeddings)
+    centroids = normalize_embeddings(centroids) if n else centroids
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'data_version': face_index.version[0], 'threshold': threshold, 'k': k, 'keys': keys,
+                         'labels': labels, 'centroids': centroids}, f)
+    _atomic_write(os.path.join(data_dir, CLUSTERS_FILE), write)
+    print(f"Visages : {n}, nouveaux visages regroupés : {len(new_faces)}, clusters : {len(centroids)}, "
+          f"clusters d'au moins 2 visages : {int((np.bincount(labels) >= 2).sum()) if n else 0}")
+    return len(centroids)
+
+
+def preprocess_report(image_folder, configs, limit=50, ctx_id=-1, match_threshold=0.5):
+    """Compare des réglages de prétraitement à la pleine résolution (det_size 640) sur un échantillon d'images.
+
+    Pour chaque réglage (dict d'options de `configure`) : images/s, visages trouvés, recall des visages de
+    référence (un visage est retrouvé si un visage de la même image a une similarité >= match_threshold)
+    et similarité moyenne des visages retrouvés. Le réglage courant est restauré à la fin.
+    Retourne une liste de dicts, la référence en premier.
+    """
+    paths = list_images(image_folder)[:limit]
+    if not paths:
+        raise ValueError(f"Aucune image trouvée dans {image_folder}")
+    saved = dict(PREPROCESS)
+    baseline_config = {'max_side': None, 'det_size': 640, 'adaptive_det_size': False, 'light_models': False}
+    report = []
+    try:
+        baseline = None
+        for config in [baseline_config] + list(configs):
+            configure(**{**baseline_config, **config})
+            model = load_model(ctx_id=ctx_id)
+            _image_faces(model, np.zeros((64, 64, 3), dtype=np.uint8))  # premier appel onnxruntime hors mesure
+            start = time.perf_counter()
+            per_image = [
+                normalize_embeddings(np.asarray([f.embedding for f in _image_faces(model, *load_image(path, PREPROCESS['max_side']))],
+                                                dtype='float32').reshape(-1, 512))
+                for path in paths
+            ]
+            elapsed = time.perf_counter() - start
+            if baseline is None:
+                baseline = per_image
+            found, similarities = 0, []
+            for ref, emb in zip(baseline, per_image):
+                if len(ref) and len(emb):
+                    best = (ref @ emb.T).max(axis=1)
+                    found += int((best >= match_threshold).sum())
+                    similarities.extend(best[best >= match_threshold])
+            total = sum(len(ref) for ref in baseline)
+            report.append({
+                'config': dict(PREPROCESS),
+                'images_per_s': len(paths) / elapsed,
+                'faces': sum(len(emb) for emb in per_image),
+                'recall': found / total if total else 1.0,
+                'similarity': float(np.mean(similarities)) if similarities else 0.0,
+            })
+    finally:
+        configure(**saved)
+    return report
+
+
+def _percentiles(samples_ms):
+    return {f'p{p}': float(np.percentile(samples_ms, p)) for p in (50, 95, 99)} if len(samples_ms) else {}
+
+
+def _peak_rss_mb():
+    """Pic de mémoire résidente (Mo) du processus et de ses processus fils terminés, None hors Unix."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss est en ko sous Linux
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def synthetic_embeddings(n, faces_per_photo=3, faces_per_person=10, seed=0):
+    """Embeddings normalisés de synthèse : n visages de n / faces_per_person personnes (similarité ~0.7 au sein
+    d'une personne), regroupés par faces_per_photo dans des photos fictives. Retourne (embeddings, chemins, num_faces)."""
+    rng = np.random.default_rng(seed)
+    people = normalize_embeddings(rng.normal(size=(max(1, n // faces_per_person), 512)).astype('float32'))
+    noise = normalize_embeddings(rng.normal(size=(n, 512)).astype('float32'))
+    embeddings_array = normalize_embeddings(people[rng.integers(0, len(people), n)] + 0.65 * noise)
+    image_paths = [f'photo_{i // faces_per_photo}.jpg' for i in range(n)]
+    num_faces_per_image = {}
+    for path in image_paths:
+        num_faces_per_image[path] = num_faces_per_image.get(path, 0) + 1
+    return embeddings_array, image_paths, num_faces_per_image
+
+
+def bench_search(n, index_type='flat', n_queries=200, k=10, threshold=0.5, storage=None, seed=0):
+    """Mesure construction, sauvegarde, chargement et latence de recherche (une requête à la fois) sur n visages
+    de synthèse, dans un dossier temporaire."""
+    embeddings_array, image_paths, num_faces_per_image = synthetic_embeddings(n, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    queries = embeddings_array[rng.integers(0, n, n_queries)]
+    queries = normalize_embeddings(queries + 0.65 * normalize_embeddings(rng.normal(size=queries.shape)))
+    data_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        start = time.perf_counter()
+        index = build_faiss_index(embeddings_array, index_type=index_type, storage=storage or 'float16')
+        build_s = time.perf_counter() - start
+        start = time.perf_counter()
+        save_index(embeddings_array, image_paths, num_faces_per_image, data_dir, data_dir=data_dir, index=index,
+                   index_params={'index_type': index_type}, storage=storage)
+        save_s = time.perf_counter() - start
+        start = time.perf_counter()
+        face_index = FaceIndex.load(data_dir)
+        load_s = time.perf_counter() - start
+
+        def latencies(**params):
+            samples = []
+            for query in queries:
+                start = time.perf_counter()
+                face_index.search_photos(query[None], **params)
+                samples.append((time.perf_counter() - start) * 1000)
+            return _percentiles(samples)
+
+        return {
+            'faces': n,
+            'index': describe_index(face_index.index),
+            'storage': load_meta(data_dir)['storage'],
+            'disk_bytes': face_index.nbytes,
+            'index_build_s': build_s,
+            'save_s': save_s,
+            'load_s': load_s,
+            'search_knn_ms': latencies(k=k),
+            'search_threshold_ms': latencies(threshold=threshold),
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def bench_images(image_folder, limit=50, workers=(1,), decode_threads=1, ctx_id=-1):
+    """Mesure le pipeline d'images sur un échantillon : décodage, détection et embedding image par image,
+    livraison des photos (copie complète et liens, voir `deliver_results`) et génération des miniatures,
+    puis débit de `embed_images` pour chaque nombre de processus de `workers`."""
+    paths = list_images(image_folder)[:limit]
+    if not paths:
+        raise ValueError(f"Aucune image trouvée dans {image_folder}")
+    model = load_model(ctx_id=ctx_id)
+    _image_faces(model, np.zeros((64, 64, 3), dtype=np.uint8))  # premier appel onnxruntime hors mesure
+    timings = {'decode': 0.0, 'detect': 0.0, 'embed': 0.0}
+    n_faces = 0
+    start = time.perf_counter()
+    for path in paths:
+        decode_start = time.perf_counter()
+        img, scale = load_image(path, max_side=PREPROCESS['max_side'])
+        timings['decode'] += time.perf_counter() - decode_start
+        n_faces += len(_image_faces(model, img, scale, timings=timings))
+    elapsed = time.perf_counter() - start
+
+    output_folder = tempfile.mkdtemp(prefix='bench-deliver-')
+    delivery = {}
+    try:
+        for stage, mode in (('copy', 'copy'), ('deliver', 'hardlink')):
+            stage_start = time.perf_counter()
+            deliver_results([(path, 1.0) for path in paths], output_folder, mode=mode, data_dir=output_folder)
+            delivery[stage] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
+        sync_thumbnails(output_folder, paths)
+        delivery['thumbnail'] = time.perf_counter() - stage_start
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+    scaling = []
+    for n_workers in workers:
+        start = time.perf_counter()
+        embeddings_array = embed_images(paths, ctx_id=ctx_id, workers=n_workers, decode_threads=decode_threads)[0]
+        wall = time.perf_counter() - start
+        scaling.append({'workers': n_workers, 'decode_threads': decode_threads, 'seconds': wall,
+                        'images_per_s': len(paths) / wall, 'faces_per_s': len(embeddings_array) / wall})
+    return {
+        'images': len(paths),
+        'faces': n_faces,
+        'preprocess': dict(PREPROCESS),
+        'stages_s': {**timings, **delivery},
+        'ms_per_image': {stage: seconds * 1000 / len(paths) for stage, seconds in {**timings, **delivery}.items()},
+        'images_per_s': len(paths) / elapsed,
+        'faces_per_s': n_faces / elapsed,
+        'workers': scaling,
+    }
+
+
+def _import_seconds():
+    """Durée d'`import engine` dans un nouveau processus Python."""
+    code = ("import sys, time; sys.path.insert(0, sys.argv[1]); start = time.perf_counter(); import engine; "
+            "print(time.perf_counter() - start)")
+    output = subprocess.run([sys.executable, '-c', code, os.path.dirname(os.path.abspath(__file__))],
+                            capture_output=True, text=True, check=True).stdout
+    return float(output)
+
+
+def bench(image_folder=None, sizes=(10000,), index_types=('flat',), workers=(1,), limit=50, n_queries=200, k=10,
+          threshold=0.5, storage=None, decode_threads=1, ctx_id=-1, seed=0):
+    """Benchmark des étapes critiques, à suivre d'une version à l'autre (sortie JSON de la commande `bench`).
+
+    Recherche : pour chaque taille de sizes et type de index_types (voir `bench_search`).
+    Images : si image_folder est donné (voir `bench_images`), précédé du chargement et du warm-up du modèle.
+    Démarrage : durée d'`import engine` dans un nouveau processus. Retourne un dict sérialisable en JSON.
+    """
+    import insightface
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'faiss': faiss.__version__,
+            'opencv': cv2.__version__,
+            'insightface': insightface.__version__,
+        },
+        'search': [bench_search(n, index_type=index_type, n_queries=n_queries, k=k, threshold=threshold,
+                                storage=storage, seed=seed)
+                   for index_type in index_types for n in sizes],
+        'startup': {'import_s': _import_seconds()},
+    }
+    if image_folder:
+        report['startup'].update(warm_up(ctx_id=ctx_id))
+        report['startup']['session_threads'] = session_threads(load_model(ctx_id=ctx_id))
+        report['images'] = bench_images(image_folder, limit=limit, workers=workers, decode_threads=decode_threads,
+                                        ctx_id=ctx_id)
+    report['peak_rss_mb'] = _peak_rss_mb()
+    return report
+
+
+def add_model_arguments(parser):
+    """Options de prétraitement et d'inférence (voir PREPROCESS, INFERENCE) communes à build, update, search et bench."""
+    parser.add_argument('--max-side', type=int, default=None,
+                        help='Réduire les images à ce côté max avant détection (décodage JPEG réduit)')
+    parser.add_argument('--det-size', type=int, default=640, help='Taille d\'entrée du détecteur')
+    parser.add_argument('--adaptive-det', action='store_true',
+                        help='Entrée du détecteur au format de l\'image plutôt que carrée')
+    parser.add_argument('--all-models', dest='light_models', action='store_false',
+                        help='Charger aussi les modèles d\'âge/genre et de landmarks (par défaut détection et '
+                             'reconnaissance seulement)')
+    parser.add_argument('--prefilter-side', type=int, default=None,
+                        help='Ignorer les images sans visage sur une miniature de ce côté (ex. 640)')
+    parser.add_argument('--dedupe', type=int, default=None, metavar='DISTANCE',
+                        help='Réutiliser les visages des photos de rafale à distance dHash <= DISTANCE (ex. 4)')
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="Secondes max par image : dépassées au décodage, la détection est évitée ; après la "
+                             "détection, la reconnaissance. L'image est indexée sans visage et réessayée au prochain update")
+    parser.add_argument('--video-fps', type=float, default=2.0, help='Images de vidéo examinées par seconde')
+    parser.add_argument('--video-samples', type=int, default=3, help='Embeddings représentatifs par piste de visage')
+    parser.add_argument('--batch-size', type=int, default=32, help='Visages par appel au modèle de reconnaissance')
+    parser.add_argument('--intra-op-threads', type=int, default=None, help='Threads onnxruntime par opérateur')
+    parser.add_argument('--inter-op-threads', type=int, default=None, help='Threads onnxruntime entre opérateurs')
+    parser.add_argument('--fork-preload', action='store_true',
+                        help='Charger le modèle une fois et forker les processus d\'inférence (1 thread onnxruntime '
+                             'par processus)')
 
 
 def main():
@@ -136,22 +2261,159 @@ def main():
     p_build.add_argument('--images', '-i', required=True, help='Dossier contenant les images à indexer')
     p_build.add_argument('--out', '-o', default='data/similar_images', help='Dossier de sortie pour les images similaires')
     p_build.add_argument('--ctx', type=int, default=-1, help='ctx_id pour insightface (-1 CPU, 0 GPU)')
+    p_build.add_argument('--workers', '-w', type=int, default=1, help='Nombre de processus d\'inférence')
+    p_build.add_argument('--decode-threads', type=int, default=1, help='Threads de décodage JPEG par processus')
+    p_build.add_argument('--data', default=DATA_DIR, help='Dossier où écrire l\'index et la métadata')
+    p_build.add_argument('--event', '-e', default=None, help='Identifiant de l\'événement : index dans <data>/events/<event>/')
+    p_build.add_argument('--hash', action='store_true', help='Enregistrer le sha1 des images dans le manifest')
+    p_build.add_argument('--index', choices=INDEX_TYPES, default='flat', help='Type d\'index FAISS (flat exact, ivf/ivfpq/hnsw approchés)')
+    p_build.add_argument('--nlist', type=int, default=None, help='Nombre de listes IVF (défaut 4 * sqrt(n))')
+    p_build.add_argument('--nprobe', type=int, default=None, help='Listes IVF visitées par recherche (défaut 16)')
+    p_build.add_argument('--ef-search', type=int, default=None, help='Candidats HNSW explorés par recherche (défaut 128)')
+    p_build.add_argument('--storage', choices=STORAGE_TYPES, default='float16',
+                         help='Stockage des embeddings et de l\'index flat (float16 par défaut ; pq : 64 octets par '
+                              'visage, similarités approchées, gros événements)')
+    p_build.add_argument('--thumb-side', type=int, default=THUMBNAIL_SIDE,
+                         help='Côté des miniatures web générées à l\'indexation (0 : aucune)')
+
+    add_model_arguments(p_build)
+
+    p_update = sub.add_parser('update', help='Mettre à jour l\'index : encoder seulement les images nouvelles ou modifiées')
+    p_update.add_argument('--images', '-i', required=True, help='Dossier contenant les images à indexer')
+    p_update.add_argument('--out', '-o', default=None, help='Dossier de sortie pour les images similaires (défaut : celui du build)')
+    p_update.add_argument('--ctx', type=int, default=-1, help='ctx_id pour insightface (-1 CPU, 0 GPU)')
+    p_update.add_argument('--workers', '-w', type=int, default=1, help='Nombre de processus d\'inférence')
+    p_update.add_argument('--decode-threads', type=int, default=1, help='Threads de décodage JPEG par processus')
+    p_update.add_argument('--data', default=DATA_DIR, help='Dossier contenant l\'index et la métadata')
+    p_update.add_argument('--event', '-e', default=None, help='Identifiant de l\'événement : index dans <data>/events/<event>/')
+    p_update.add_argument('--hash', action='store_true', help='Comparer aussi le contenu (sha1) quand le mtime a changé')
+    p_update.add_argument('--thumb-side', type=int, default=THUMBNAIL_SIDE,
+                          help='Côté des miniatures web générées à l\'indexation (0 : aucune)')
+
+    add_model_arguments(p_update)
 
     p_search = sub.add_parser('search', help='Rechercher les visages similaires pour une image cible (utilise les embeddings sauvegardés)')
-    p_search.add_argument('--target', '-t', required=True, help='Chemin vers l\'image cible')
+    p_search.add_argument('--target', '-t', required=True, nargs='+', help='Chemin vers l\'image cible (ou plusieurs selfies)')
     p_search.add_argument('--k', '-k', type=int, default=5, help='Nombre de résultats à retourner')
+    p_search.add_argument('--threshold', type=float, default=None,
+                          help='Retourner tous les visages de similarité cosinus supérieure au seuil (ignore --k)')
     p_search.add_argument('--ctx', type=int, default=-1, help='ctx_id pour insightface (-1 CPU, 0 GPU)')
-    p_search.add_argument('--no-copy', action='store_true', help="Ne pas copier les images similaires dans le dossier d\'output")
+    p_search.add_argument('--all-faces', action='store_true', help='Chercher tous les visages des images cibles (selfie de groupe)')
+    p_search.add_argument('--mode', choices=('any', 'all'), default='any',
+                          help='any : photos de l\'une des personnes, all : photos de toutes les personnes')
+    p_search.add_argument('--clusters', action='store_true',
+                          help='Chercher parmi les centroïdes des identités (après `cluster`) puis leurs photos')
+    p_search.add_argument('--delivery', choices=DELIVERY_MODES, default='hardlink',
+                          help='Livraison des images similaires dans un sous-dossier du dossier d\'output (voir deliver_results)')
+    p_search.add_argument('--no-copy', action='store_true', help="Ne rien livrer dans le dossier d\'output")
+    p_search.add_argument('--data', default=DATA_DIR, help='Dossier contenant l\'index et la métadata')
+    p_search.add_argument('--event', '-e', default=None, help='Identifiant de l\'événement : index dans <data>/events/<event>/')
+
+    add_model_arguments(p_search)
+
+    p_cluster = sub.add_parser('cluster', help='Regrouper les visages indexés par identité (recherche par cluster, galerie)')
+    p_cluster.add_argument('--data', default=DATA_DIR, help='Dossier contenant l\'index et la métadata')
+    p_cluster.add_argument('--event', '-e', default=None, help='Identifiant de l\'événement : index dans <data>/events/<event>/')
+    p_cluster.add_argument('--threshold', type=float, default=0.5, help='Similarité cosinus min entre visages reliés')
+    p_cluster.add_argument('--k', '-k', type=int, default=20, help='Voisins examinés par visage')
+    p_cluster.add_argument('--full', action='store_true', help='Tout regrouper à nouveau au lieu de l\'incrémental')
+    p_cluster.add_argument('--people', type=int, default=10, help='Nombre de personnes à afficher')
+
+    p_report = sub.add_parser('index-report', help='Mesurer recall et latence de l\'index par rapport à une recherche exacte')
+    p_report.add_argument('--data', default=DATA_DIR, help='Dossier contenant l\'index et la métadata')
+    p_report.add_argument('--k', '-k', type=int, default=10, help='Nombre de voisins pour le recall@k')
+    p_report.add_argument('--queries', type=int, default=200, help='Nombre de requêtes')
+    p_report.add_argument('--nprobe', type=int, nargs='*', default=None, help='Valeurs de nprobe à comparer (IVF)')
+    p_report.add_argument('--ef-search', type=int, nargs='*', default=None, help='Valeurs de efSearch à comparer (HNSW)')
+
+    p_preprocess = sub.add_parser('preprocess-report',
+                                  help='Comparer débit et recall de réglages de prétraitement à la pleine résolution')
+    p_preprocess.add_argument('--images', '-i', required=True, help='Dossier d\'images échantillon')
+    p_preprocess.add_argument('--limit', type=int, default=50, help='Nombre d\'images mesurées')
+    p_preprocess.add_argument('--ctx', type=int, default=-1, help='ctx_id pour insightface (-1 CPU, 0 GPU)')
+    p_preprocess.add_argument('--max-side', type=int, nargs='+', default=[2048, 1280],
+                              help='Côtés max à comparer (réduction au décodage JPEG)')
+    p_preprocess.add_argument('--det-size', type=int, nargs='+', default=[640], help='Tailles d\'entrée du détecteur à comparer')
+    p_preprocess.add_argument('--adaptive-det', action='store_true', help='Entrée du détecteur au format de l\'image')
+    p_preprocess.add_argument('--light-models', action='store_true', help='Charger seulement détection et reconnaissance')
+
+    p_bench = sub.add_parser('bench', help='Benchmark construction, chargement, recherche et pipeline d\'images (JSON)')
+    p_bench.add_argument('--images', '-i', default=None, help='Dossier d\'images à mesurer (ex. data/img_GBU)')
+    p_bench.add_argument('--limit', type=int, default=50, help='Nombre d\'images mesurées')
+    p_bench.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                         help='Nombres de visages de synthèse indexés')
+    p_bench.add_argument('--index', choices=INDEX_TYPES, nargs='+', default=['flat'], help='Types d\'index mesurés')
+    p_bench.add_argument('--storage', choices=STORAGE_TYPES, default=None, help='Stockage des embeddings')
+    p_bench.add_argument('--workers', '-w', type=int, nargs='+', default=[1], help='Nombres de processus d\'inférence')
+    p_bench.add_argument('--decode-threads', type=int, default=1, help='Threads de décodage JPEG par processus')
+    p_bench.add_argument('--queries', type=int, default=200, help='Nombre de requêtes de recherche')
+    p_bench.add_argument('--k', '-k', type=int, default=10, help='Nombre de voisins des recherches k-NN')
+    p_bench.add_argument('--threshold', type=float, default=0.5, help='Seuil des recherches par similarité')
+    p_bench.add_argument('--ctx', type=int, default=-1, help='ctx_id pour insightface (-1 CPU, 0 GPU)')
+    p_bench.add_argument('--output', '-o', default=None, help='Fichier JSON où écrire le rapport (sinon stdout)')
+    add_model_arguments(p_bench)
 
     args = parser.parse_args()
+    if hasattr(args, 'adaptive_det') and args.cmd != 'preprocess-report':
+        configure(max_side=args.max_side, det_size=args.det_size, adaptive_det_size=args.adaptive_det,
+                  light_models=args.light_models, prefilter_side=args.prefilter_side, dedupe_distance=args.dedupe,
+                  time_budget=args.time_budget, video_fps=args.video_fps, video_samples=args.video_samples,
+                  batch_size=args.batch_size, intra_op_threads=args.intra_op_threads,
+                  inter_op_threads=args.inter_op_threads, fork_preload=args.fork_preload)
+    if getattr(args, 'event', None):
+        args.data = event_data_dir(args.event, args.data)
     if args.cmd == 'build':
-        build_embeddings(args.images, output_folder=args.out, ctx_id=args.ctx)
+        build_embeddings(args.images, output_folder=args.out, ctx_id=args.ctx, data_dir=args.data, use_hash=args.hash,
+                         workers=args.workers, decode_threads=args.decode_threads,
+                         index_params={'index_type': args.index, 'nlist': args.nlist, 'nprobe': args.nprobe,
+                                       'ef_search': args.ef_search},
+                         storage=args.storage, thumbnail_side=args.thumb_side)
+    elif args.cmd == 'update':
+        update_embeddings(args.images, output_folder=args.out, ctx_id=args.ctx, data_dir=args.data, use_hash=args.hash,
+                          workers=args.workers, decode_threads=args.decode_threads, thumbnail_side=args.thumb_side)
     elif args.cmd == 'search':
-        results = search_image(args.target, k=args.k, ctx_id=args.ctx, copy_results=not args.no_copy)
+        results = search_image(args.target, k=args.k, ctx_id=args.ctx, data_dir=args.data, threshold=args.threshold,
+                               all_faces=args.all_faces, mode=args.mode, use_clusters=args.clusters)
         print('\nImages similaires :')
-        for i, (path, dist) in enumerate(results, start=1):
-            print(f"{i}. {path} (distance={dist:.4f})")
-        print(f"\nLes images similaires ont été copiées dans le dossier : {load_embeddings()[3]}")
+        for i, (path, similarity) in enumerate(results, start=1):
+            print(f"{i}. {path} (similarité={similarity:.4f})")
+        if not args.no_copy:
+            request_dir = deliver_results(results, get_index(args.data).output_folder, mode=args.delivery,
+                                          data_dir=args.data)
+            print(f"\nLes images similaires ont été livrées dans le dossier : {request_dir}")
+    elif args.cmd == 'cluster':
+        cluster_faces(args.data, threshold=args.threshold, k=args.k, full=args.full)
+        total, people = get_index(args.data).people(limit=args.people)
+        print(f"\nPersonnes (au moins 2 visages) : {total}")
+        for person in people:
+            print(f"cluster {person['cluster']} : {person['photos']} photos, {person['faces']} visages "
+                  f"(portrait : {person['photo_path']})")
+    elif args.cmd == 'index-report':
+        report = index_report(args.data, k=args.k, n_queries=args.queries, nprobes=args.nprobe, ef_searches=args.ef_search)
+        print(f"{'Index':<40} {'recall@' + str(args.k):>10} {'ms/requête':>12}")
+        for row in report:
+            print(f"{row['index']:<40} {row['recall']:>10.3f} {row['ms_per_query']:>12.3f}")
+    elif args.cmd == 'preprocess-report':
+        configs = [{'max_side': max_side, 'det_size': det_size, 'adaptive_det_size': args.adaptive_det,
+                    'light_models': args.light_models}
+                   for max_side in args.max_side for det_size in args.det_size]
+        report = preprocess_report(args.images, configs, limit=args.limit, ctx_id=args.ctx)
+        print(f"{'max_side':>9} {'det':>5} {'adapt':>6} {'léger':>6} {'img/s':>8} {'visages':>8} {'recall':>7} {'similarité':>11}")
+        for row in report:
+            config = row['config']
+            print(f"{str(config['max_side'] or 'plein'):>9} {config['det_size']:>5} {str(config['adaptive_det_size']):>6} "
+                  f"{str(config['light_models']):>6} {row['images_per_s']:>8.2f} {row['faces']:>8} {row['recall']:>7.3f} "
+                  f"{row['similarity']:>11.3f}")
+    elif args.cmd == 'bench':
+        report = bench(args.images, sizes=args.sizes, index_types=args.index, workers=args.workers, limit=args.limit,
+                       n_queries=args.queries, k=args.k, threshold=args.threshold, storage=args.storage,
+                       decode_threads=args.decode_threads, ctx_id=args.ctx)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Rapport écrit dans {args.output}")
+        else:
+            print(json.dumps(report, indent=2))
     else:
         parser.print_help()
 
@@ -17,20 +17,24 @@ export async function POST(request: Request) {
 
     const pythonApiUrl = process.env.PYTHON_API_URL || "http://localhost:8000"
 
-    // Extract embedding from reference image
-    const embeddingResponse = await fetch(`${pythonApiUrl}/api/extract-embeddings`, {
+    // Face extraction and search in one call: the embedding never travels through this route
+    const searchResponse = await fetch(`${pythonApiUrl}/api/search-by-selfie`, {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ image_url: referenceImageUrl }),
+      body: JSON.stringify({
+        image: referenceImageUrl,
+        threshold,
+        event_id: eventId,
+      }),
     })
 
-    if (!embeddingResponse.ok) {
-      throw new Error("Failed to extract face embedding from reference image")
+    if (!searchResponse.ok) {
+      throw new Error("Failed to search for matching faces")
     }
 
-    const { embeddings } = await embeddingResponse.json()
+    const { matches, num_faces } = await searchResponse.json()
 
-    if (!embeddings || embeddings.length === 0) {
+    if (!num_faces) {
       return NextResponse.json({
         success: false,
         message: "No face detected in reference image",
@@ -38,27 +42,8 @@ export async function POST(request: Request) {
       })
     }
 
-    const referenceEmbedding = embeddings[0].vector
-
-    // Search for similar faces
-    const searchResponse = await fetch(`${pythonApiUrl}/api/search-faces`, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        reference_embedding: referenceEmbedding,
-        threshold,
-        event_id: eventId,
-      }),
-    })
-
-    if (!searchResponse.ok) {
-      throw new Error("Failed to search for matching faces")
-    }
-
-    const { matches } = await searchResponse.json()
-
     // Get photo details from database
-    const photoIds = matches.map((m: any) => m.photo_id)
+    const photoIds = matches.map((m: any) => m.photo_path)
     const { data: photos } = await supabase.from("photos").select("*").in("id", photoIds)
 
     return NextResponse.json({
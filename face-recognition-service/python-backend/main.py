@@ -2,25 +2,369 @@
 FastAPI Backend for Face Recognition Service with Multi-Upload Support
 """
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Union
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import pickle
+import stat
+import struct
+import threading
+import time
+import uuid
 import numpy as np
-from PIL import Image
-from io import BytesIO
 import base64
 import os
 import sys
-import tempfile
-import cv2
-import requests
+import httpx
 
 # Import engine.py from parent directory
 sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+_import_start = time.perf_counter()
 import engine
+ENGINE_IMPORT_S = time.perf_counter() - _import_start
 
 app = FastAPI(title="Face Recognition API")
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger("face_api")
+
+# Image download limits for /api/extract-embeddings
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 16))
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", 15.0))
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 30 * 1024 * 1024))
+# Threads running face detection / embedding (onnxruntime releases the GIL)
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 2))
+# Memory budget for event index shards kept loaded (LRU), see engine.get_index
+engine.INDEX_CACHE_BYTES = int(os.environ.get("INDEX_CACHE_BYTES", engine.INDEX_CACHE_BYTES))
+# Image preprocessing and model execution, see engine.configure
+engine.configure(
+    max_side=int(os.environ["MAX_IMAGE_SIDE"]) if os.environ.get("MAX_IMAGE_SIDE") else None,
+    det_size=int(os.environ.get("DET_SIZE", 640)),
+    adaptive_det_size=os.environ.get("ADAPTIVE_DET_SIZE", "0") == "1",
+    light_models=os.environ.get("LIGHT_MODELS", "1") == "1",
+    batch_size=int(os.environ.get("REC_BATCH_SIZE", 32)),
+    intra_op_threads=int(os.environ["ORT_INTRA_OP_THREADS"]) if os.environ.get("ORT_INTRA_OP_THREADS") else None,
+    inter_op_threads=int(os.environ["ORT_INTER_OP_THREADS"]) if os.environ.get("ORT_INTER_OP_THREADS") else None,
+)
+# Model warm-up before serving, or at import time so that forked workers (gunicorn --preload) share the
+# loaded sessions; onnxruntime sessions only survive a fork with ORT_INTRA_OP_THREADS=1
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "0") == "1"
+if PRELOAD_MODEL:
+    engine.warm_up()
+    if any(threads != (1, 1) for threads in engine.session_threads(engine.MODEL).values()):
+        raise RuntimeError("PRELOAD_MODEL=1 requires ORT_INTRA_OP_THREADS=1 (and ORT_INTER_OP_THREADS unset or 1): "
+                           "multi-threaded onnxruntime sessions do not survive a fork")
+# Observability: one JSON log line with stage timings per request, and GET /debug/profile
+LOG_REQUEST_TIMINGS = os.environ.get("LOG_REQUEST_TIMINGS", "1") == "1"
+ENABLE_PROFILER = os.environ.get("ENABLE_PROFILER", "0") == "1"
+
+
+class Metrics:
+    """In-process counters and histograms, rendered in the Prometheus text format by GET /metrics."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * len(self.BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self, gauges: dict = None) -> str:
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in zip(self.BUCKETS, histogram):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram[-1]}")
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+# Stage timings (seconds) of the request being served, set by the timing middleware
+request_spans: contextvars.ContextVar = contextvars.ContextVar("request_spans", default=None)
+
+
+def add_spans(timings: dict):
+    """Add stage timings to the current request and to the per-stage latency histograms."""
+    spans = request_spans.get()
+    for stage, seconds in timings.items():
+        metrics.observe("face_api_stage_seconds", seconds, stage=stage)
+        if spans is not None:
+            spans[stage] = spans.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block running on the event loop (inference threads pass their own timings dict to add_spans)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_spans({stage: time.perf_counter() - start})
+
+
+# Query cache (selfie embeddings and per-event result lists), see QueryCache
+QUERY_CACHE_ENTRIES = int(os.environ.get("QUERY_CACHE_ENTRIES", 1024))
+QUERY_CACHE_DIR = os.environ.get("QUERY_CACHE_DIR") or None
+QUERY_CACHE_DISK_ENTRIES = int(os.environ.get("QUERY_CACHE_DISK_ENTRIES", 100000))
+
+
+class QueryCache:
+    """
+    Content-hash keyed LRU cache, with an optional on-disk tier shared by workers and restarts.
+    Keys are hex digests; values must be picklable. Disk entries past `max_disk_entries` are
+    dropped oldest first, down to 90% of the limit: the directory is scanned only when the entries
+    counted since the last scan exceed the limit, not on every put.
+    """
+
+    def __init__(self, max_entries: int, cache_dir: str = None, max_disk_entries: int = 100000):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_entries = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_entries = len(self._disk_files())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def get(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        value = None
+        if self.cache_dir:
+            try:
+                with open(self._path(key), "rb") as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                value = None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key: str, value):
+        with self.lock:
+            self._remember(key, value)
+        if self.cache_dir:
+            path = self._path(key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.disk_entries += 1
+                prune = self.disk_entries > self.max_disk_entries
+            if prune:
+                self._prune_disk()
+
+    def _remember(self, key: str, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _disk_files(self) -> list:
+        with os.scandir(self.cache_dir) as it:
+            return [entry for entry in it if entry.name.endswith(".pkl")]
+
+    def _prune_disk(self):
+        files = self._disk_files()
+        keep = len(files)
+        if len(files) > self.max_disk_entries:
+            keep = self.max_disk_entries * 9 // 10
+            files.sort(key=lambda entry: entry.stat().st_mtime_ns)
+            for entry in files[:len(files) - keep]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        with self.lock:
+            self.disk_entries = keep
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+def cache_key(*parts) -> str:
+    """sha1 over bytes / str parts (image content, embeddings, search parameters)."""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, (bytes, bytearray, memoryview)) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+query_cache = QueryCache(QUERY_CACHE_ENTRIES, QUERY_CACHE_DIR, QUERY_CACHE_DISK_ENTRIES)
+# Background ingestion jobs, see JobStore
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(engine.DATA_DIR, "jobs"))
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", 8))
+INGEST_FLUSH_SIZE = int(os.environ.get("INGEST_FLUSH_SIZE", 50))
+# Directory job photos may be read from by path; unset, jobs only accept URLs and data URIs
+JOBS_LOCAL_ROOT = os.environ.get("JOBS_LOCAL_ROOT") or None
+
+
+class JobStore:
+    """
+    File-backed ingestion job queue: `<id>.json` holds the job state, `<id>.results.jsonl` the
+    per-photo results, appended in batches. Jobs left queued or running by a restart are resumed,
+    skipping photos that already have a result.
+    """
+
+    def __init__(self, jobs_dir: str):
+        self.jobs_dir = jobs_dir
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _path(self, job_id: str, suffix: str = ".json") -> str:
+        if not job_id.isalnum():
+            raise ValueError("Invalid job id")
+        return os.path.join(self.jobs_dir, job_id + suffix)
+
+    def save(self, job: dict):
+        path = self._path(job["id"])
+        with open(path + ".tmp", "w") as f:
+            json.dump(job, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, job_id: str) -> dict:
+        with open(self._path(job_id)) as f:
+            return json.load(f)
+
+    def create(self, photos: List[dict], event_id: Union[str, None], index: bool) -> dict:
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "event_id": event_id,
+            "index": index,
+            "photos": photos,
+            "total": len(photos),
+            "processed": 0,
+            "failed": 0,
+            "faces": 0,
+            "created_at": time.time(),
+            "finished_at": None,
+            "error": None,
+        }
+        self.save(job)
+        return job
+
+    def unfinished(self) -> List[dict]:
+        jobs = []
+        for name in os.listdir(self.jobs_dir):
+            if name.endswith(".json"):
+                job = self.load(name[:-len(".json")])
+                if job["status"] in ("queued", "running"):
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job["created_at"])
+
+    def append_results(self, job_id: str, rows: List[dict]):
+        with open(self._path(job_id, ".results.jsonl"), "a") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+
+    def results(self, job_id: str) -> List[dict]:
+        try:
+            with open(self._path(job_id, ".results.jsonl")) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+
+job_store: JobStore = None
+job_queue: asyncio.Queue = None
+job_runner_task: asyncio.Task = None
+
+http_client: httpx.AsyncClient = None
+download_semaphore: asyncio.Semaphore = None
+inference_pool = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+
+@app.on_event("startup")
+async def startup():
+    global http_client, download_semaphore
+    http_client = httpx.AsyncClient(
+        timeout=DOWNLOAD_TIMEOUT,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=MAX_CONCURRENT_DOWNLOADS),
+    )
+    download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+    if WARMUP and engine.STARTUP["warmup_s"] is None:
+        await asyncio.get_running_loop().run_in_executor(inference_pool, engine.warm_up)
+    logger.info(json.dumps({"event": "startup", "engine_import_s": ENGINE_IMPORT_S, **engine.STARTUP}))
+
+    global job_store, job_queue, job_runner_task
+    job_store = JobStore(JOBS_DIR)
+    job_queue = asyncio.Queue()
+    for job in job_store.unfinished():
+        job_queue.put_nowait(job["id"])
+    job_runner_task = asyncio.create_task(run_jobs())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # An interrupted job stays "running" on disk and is resumed at the next startup
+    job_runner_task.cancel()
+    await http_client.aclose()
+    inference_pool.shutdown(wait=False)
 
 # Configure CORS
 app.add_middleware(
@@ -31,10 +375,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_timings(request: Request, call_next):
+    """Collect the request's stage spans: Server-Timing header, request histogram and one JSON log line."""
+    spans = {}
+    token = request_spans.set(spans)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_spans.reset(token)
+    total = time.perf_counter() - start
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    metrics.observe("face_api_request_seconds", total, route=route)
+    metrics.inc("face_api_requests_total", route=route, status=response.status_code)
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans.items()] + [f"total;dur={total * 1000:.1f}"])
+    if LOG_REQUEST_TIMINGS:
+        logger.info(json.dumps({"route": route, "status": response.status_code, "ms": round(total * 1000, 2),
+                                "spans_ms": {stage: round(seconds * 1000, 2) for stage, seconds in spans.items()}}))
+    return response
+
 # Request models
 class ExtractEmbeddingsRequest(BaseModel):
     images: List[str]  # list of URLs or Base64 strings
 
+class SearchFacesRequest(BaseModel):
+    reference_embedding: Union[List[float], None] = None
+    reference_embeddings: Union[List[List[float]], None] = None  # several faces searched in one index pass
+    mode: str = "any"  # "any": photos of any of the faces, "all": photos containing all of them
+    threshold: float = 0.6
+    event_id: Union[str, None] = None  # search this event's shard; global index when omitted
+    offset: int = Field(0, ge=0)
+    limit: int = Field(100, ge=1)
+    use_clusters: bool = False  # match identity cluster centroids (after `engine.py cluster`), then their photos
+
 class EmbeddingResponse(BaseModel):
     vector: list[float]
     confidence: float
@@ -44,17 +419,24 @@ class EmbeddingResponse(BaseModel):
 def read_root():
     return {"status": "Face Recognition API is running"}
 
+@app.get("/health")
+def health():
+    """Readiness: whether the model is loaded, and the startup durations in seconds."""
+    return {
+        "status": "ok",
+        "model_loaded": engine.MODEL is not None,
+        "startup_s": {"engine_import": ENGINE_IMPORT_S, "model_load": engine.STARTUP["model_load_s"],
+                      "warmup": engine.STARTUP["warmup_s"]},
+    }
+
 @app.post("/api/extract-embeddings")
 async def extract_embeddings(request: Request):
     """
     Extract embeddings for multiple images.
     Supports image URLs or Base64 images.
+    With `Accept: application/octet-stream` the response is the binary format of pack_embeddings,
+    with per-image errors in the X-Image-Errors header.
     """
-    # Prepare input normalization
-    all_results = []
-    print("request",request)
-    # return all_results
-
     # Normalize request body to a list of image strings
     try:
         body = await request.json()
@@ -69,93 +451,530 @@ async def extract_embeddings(request: Request):
     else:
         raise HTTPException(status_code=422, detail="Body must be { images: string[] } or a JSON array of strings")
 
-    total_images = len(images_list)
-    for idx, img_input in enumerate(images_list):
-        print(f"Processing image {idx+1}/{total_images}")
+    results = await asyncio.gather(*(process_image(idx, img_input) for idx, img_input in enumerate(images_list)))
 
-        try:
-            # Load image
-            if isinstance(img_input, str) and img_input.startswith("data:image"):
-                header, encoded = img_input.split(",", 1)
-                image = Image.open(BytesIO(base64.b64decode(encoded)))
-            else:
-                response = requests.get(img_input)
-                image = Image.open(BytesIO(response.content))
-
-            # Save temporarily to disk (engine.py works with file paths)
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-                tmp_path = tmp.name
-                image.save(tmp_path)
+    with span("serialize"):
+        if BINARY_MEDIA_TYPE in request.headers.get("accept", ""):
+            errors = {result["image_index"]: result["error"] for result in results if "error" in result}
+            return Response(pack_embeddings(results), media_type=BINARY_MEDIA_TYPE,
+                            headers={"X-Image-Errors": json.dumps(errors)} if errors else None)
+        return JSONResponse({"results": [result_to_json(result) for result in results]})
 
-            try:
-                model = engine.load_model(ctx_id=-1)
-                img_cv = cv2.imread(tmp_path)
-                faces = model.get(img_cv)
-
-                embeddings = []
-                for i, face in enumerate(faces):
-                    print(f"  Face {i+1}/{len(faces)} in image {idx+1}")
-                    embeddings.append({
-                        "vector": face.embedding.tolist(),
-                        "confidence": float(face.det_score),
-                        "bbox": face.bbox.tolist()
-                    })
-
-                all_results.append({
-                    "image_index": idx,
-                    "num_faces": len(faces),
-                    "embeddings": embeddings
-                })
-
-            finally:
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
+async def download_image(url: str) -> bytes:
+    """
+    Download an image with the shared client, at most MAX_CONCURRENT_DOWNLOADS at a time.
+    Raises ValueError when the body exceeds MAX_IMAGE_BYTES.
+    """
+    async with download_semaphore:
+        with span("download"):
+            async with http_client.stream("GET", url) as response:
+                response.raise_for_status()
+                if int(response.headers.get("content-length") or 0) > MAX_IMAGE_BYTES:
+                    raise ValueError(f"Image larger than {MAX_IMAGE_BYTES} bytes")
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > MAX_IMAGE_BYTES:
+                        raise ValueError(f"Image larger than {MAX_IMAGE_BYTES} bytes")
+                    chunks.append(chunk)
+                return b"".join(chunks)
 
-        except Exception as e:
-            print(f"Error processing image {idx+1}: {e}")
-            all_results.append({
-                "image_index": idx,
-                "num_faces": 0,
-                "embeddings": [],
-                "error": str(e)
-            })
+async def load_image_bytes(img_input: str, local_root: str = None) -> bytes:
+    """Return the encoded image for a data URI, a URL or (with local_root) a path under local_root."""
+    if isinstance(img_input, str) and img_input.startswith("data:image"):
+        header, encoded = img_input.split(",", 1)
+        return base64.b64decode(encoded)
+    if not img_input.startswith(("http://", "https://")):
+        if local_root is None:
+            raise ValueError("Image must be an http(s) URL or a data URI")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(inference_pool, read_file, img_input, local_root)
+    return await download_image(img_input)
 
-    print("All images processed.")
-    return {"results": all_results}
+def read_file(path: str, root: str) -> bytes:
+    """
+    Read an image by path, relative to `root` or absolute. Paths resolving outside `root` (through `..` or
+    symlinks) and anything but regular files (devices, FIFOs) are rejected; at most MAX_IMAGE_BYTES are read.
+    """
+    root = os.path.realpath(root)
+    real_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, real_path]) != root:
+        raise ValueError("Path outside JOBS_LOCAL_ROOT")
+    # O_NONBLOCK so that opening a FIFO does not wait for a writer before it is rejected
+    fd = os.open(real_path, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0))
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            raise ValueError("Not a regular file")
+        with open(fd, "rb", closefd=False) as f:
+            data = f.read(MAX_IMAGE_BYTES + 1)
+    finally:
+        os.close(fd)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f"Image larger than {MAX_IMAGE_BYTES} bytes")
+    return data
 
-@app.post("/api/search-faces")
-async def search_faces(reference_embedding: List[float], threshold: float = 0.6):
+def face_arrays(data: bytes, timings: dict = None) -> dict:
+    """
+    Decode an image straight from the buffer and return its faces as arrays: "vectors" float32 (n, 512),
+    "confidence" (n,) and "bbox" (n, 4). `timings` accumulates decode / detect / embed seconds.
+    """
+    start = time.perf_counter()
+    img = engine.decode_image(memoryview(data))
+    if timings is not None:
+        timings["decode"] = timings.get("decode", 0.0) + time.perf_counter() - start
+    if img is None:
+        raise ValueError("Could not decode image")
+    faces = engine.detect_faces(img, ctx_id=-1, timings=timings)
+    return {
+        "vectors": np.array([face.embedding for face in faces], dtype=np.float32).reshape(len(faces), -1),
+        "confidence": np.array([face.det_score for face in faces], dtype=np.float32),
+        "bbox": np.array([face.bbox for face in faces], dtype=np.float32).reshape(len(faces), 4),
+    }
+
+def faces_to_json(faces: dict) -> List[dict]:
+    return [
+        {"vector": vector.tolist(), "confidence": float(confidence), "bbox": bbox.tolist()}
+        for vector, confidence, bbox in zip(faces["vectors"], faces["confidence"], faces["bbox"])
+    ]
+
+def face_embeddings(data: bytes, timings: dict = None) -> List[dict]:
+    """Faces of an image as JSON-ready dicts, see face_arrays."""
+    return faces_to_json(face_arrays(data, timings))
+
+def extract_faces(data: bytes, timings: dict = None) -> dict:
     """
-    Search for similar faces using FAISS index from engine.py
+    Face arrays of an image, see face_arrays. Runs on the inference pool.
+    Results are cached by image content and preprocessing settings, so a retried selfie skips the model.
     """
+    key = cache_key("face_arrays", data, sorted(engine.PREPROCESS.items()))
+    faces = query_cache.get(key)
+    if faces is None:
+        faces = face_arrays(data, timings)
+        query_cache.put(key, faces)
+    else:
+        metrics.inc("face_api_cache_hits_total", kind="faces")
+    return faces
+
+async def process_image(idx: int, img_input: str):
+    """Fetch or decode one input image, then run inference off the event loop."""
     try:
-        embeddings_array, image_paths, num_faces_per_image, output_folder = engine.load_embeddings()
-        if embeddings_array.size == 0:
-            return {"matches": []}
-
-        index = engine.build_faiss_index(embeddings_array)
-        reference_emb = np.array([reference_embedding]).astype('float32')
-        k = min(10, len(embeddings_array))
-        distances, indices = index.search(reference_emb, k)
-
-        matches = []
-        for i, idx in enumerate(indices[0]):
-            distance = float(distances[0][i])
-            similarity = 1 / (1 + distance)
-            if similarity > threshold:
-                matches.append({
-                    "photo_path": image_paths[idx],
-                    "similarity": similarity,
-                    "distance": distance
-                })
-
-        return {"matches": matches}
+        data = await load_image_bytes(img_input)
+        loop = asyncio.get_running_loop()
+        timings = {}
+        faces = await loop.run_in_executor(inference_pool, extract_faces, data, timings)
+        add_spans(timings)
+        metrics.inc("face_api_images_total", source="request")
+        metrics.inc("face_api_faces_total", len(faces["vectors"]), source="request")
+        return {"image_index": idx, "faces": faces}
+
+    except Exception as e:
+        metrics.inc("face_api_image_errors_total", source="request")
+        logger.warning("Error processing image %d: %s", idx + 1, e)
+        return {"image_index": idx, "error": str(e)}
+
+def result_to_json(result: dict) -> dict:
+    if "error" in result:
+        return {"image_index": result["image_index"], "num_faces": 0, "embeddings": [], "error": result["error"]}
+    return {
+        "image_index": result["image_index"],
+        "num_faces": len(result["faces"]["vectors"]),
+        "embeddings": faces_to_json(result["faces"]),
+    }
 
+# Binary embeddings (Accept / Content-Type application/octet-stream), little-endian:
+# header (magic, version, dimension, image count, face count), uint32 face count per image,
+# then float32 confidences (F), bboxes (F x 4) and vectors (F x dimension), in image order.
+# Every section is 4-byte aligned, so clients can read them as Float32Array / numpy views.
+BINARY_MEDIA_TYPE = "application/octet-stream"
+BINARY_MAGIC = b"FEMB"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHII")
+
+def pack_embeddings(results: List[dict]) -> bytes:
+    faces = [result["faces"] for result in results if "error" not in result]
+    counts = np.array([0 if "error" in result else len(result["faces"]["vectors"]) for result in results],
+                      dtype="<u4")
+    vectors = (np.concatenate([f["vectors"] for f in faces]) if faces else np.empty((0, 512))).astype("<f4")
+    confidence = (np.concatenate([f["confidence"] for f in faces]) if faces else np.empty(0)).astype("<f4")
+    bbox = (np.concatenate([f["bbox"] for f in faces]) if faces else np.empty((0, 4))).astype("<f4")
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, vectors.shape[1], len(results), len(vectors))
+    return b"".join([header, counts.tobytes(), confidence.tobytes(), bbox.tobytes(), vectors.tobytes()])
+
+def unpack_embeddings(data: bytes) -> np.ndarray:
+    """Vectors (F, dimension) of a pack_embeddings body. Raises ValueError on a malformed body."""
+    if len(data) < BINARY_HEADER.size:
+        raise ValueError("Binary body too short")
+    magic, version, dim, n_images, n_faces = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a binary embeddings body (bad magic or version)")
+    offset = BINARY_HEADER.size + 4 * n_images + 4 * n_faces * 5
+    if len(data) != offset + 4 * n_faces * dim:
+        raise ValueError("Binary body size does not match its header")
+    return np.frombuffer(data, dtype="<f4", count=n_faces * dim, offset=offset).reshape(n_faces, dim)
+
+def with_thumbnail_url(photo: dict, event_id: Union[str, None]) -> dict:
+    """Replace the thumbnail path of a search or people entry with its GET /api/thumbnails URL."""
+    if not photo.get("thumbnail"):
+        return photo
+    url = f"/api/thumbnails/{os.path.basename(photo['thumbnail'])}"
+    return {**photo, "thumbnail": f"{url}?event_id={event_id}" if event_id else url}
+
+def search_index(data_dir: str, reference_emb: np.ndarray, params, timings: dict) -> List[dict]:
+    """
+    Full photo list for the reference faces, from the query cache or the event's index. Runs in the default
+    executor, off the event loop (a cold shard load and the FAISS search block, engine.get_index holds a
+    process-wide lock meanwhile) and without queueing behind face extraction on the inference pool.
+    """
+    # A rebuilt or updated index has a new version, which makes older cached results unreachable
+    key = cache_key("photos", data_dir, engine.index_version(data_dir), reference_emb.shape, reference_emb.tobytes(),
+                    params.threshold, params.mode, params.use_clusters)
+    photos = query_cache.get(key)
+    if photos is not None:
+        metrics.inc("face_api_cache_hits_total", kind="photos")
+        return photos
+    # Shared, memory-mapped shard kept in an LRU cache; reloaded only when a new version is built
+    start = time.perf_counter()
+    face_index = engine.get_index(data_dir)
+    timings["index_load"] = time.perf_counter() - start
+    if face_index.ntotal == 0:
+        return []
+    if reference_emb.shape[1] != face_index.index.d:
+        raise HTTPException(status_code=422, detail=f"Reference embeddings have {reference_emb.shape[1]} "
+                                                    f"dimensions, the index expects {face_index.index.d}")
+    start = time.perf_counter()
+    photos = face_index.search_photos(reference_emb, threshold=params.threshold, mode=params.mode,
+                                      use_clusters=params.use_clusters)["photos"]
+    timings["search"] = time.perf_counter() - start
+    query_cache.put(key, photos)
+    return photos
+
+async def find_photos(reference_emb: np.ndarray, params, extra: dict = None) -> JSONResponse:
+    """
+    Photos matching the reference faces, for the search parameters of `params` (a SearchFacesRequest or
+    SelfieSearchRequest). Full result lists are cached per index version, so repeated searches and further
+    pages skip the index (see search_index). `extra` fields are added to the response.
+    """
+    if reference_emb.ndim != 2 or not reference_emb.shape[1]:
+        raise HTTPException(status_code=422, detail="Reference embeddings must be a list of vectors")
+    try:
+        data_dir = engine.DATA_DIR
+        if params.event_id:
+            data_dir = engine.event_data_dir(params.event_id)
+
+        timings = {}
+        photos = await asyncio.get_running_loop().run_in_executor(
+            None, search_index, data_dir, reference_emb, params, timings)
+        add_spans(timings)
+
+        end = None if params.limit is None else params.offset + params.limit
+        with span("serialize"):
+            matches = [with_thumbnail_url(photo, params.event_id) for photo in photos[params.offset:end]]
+            return JSONResponse({"matches": matches, "total": len(photos), **(extra or {})})
+
+    except HTTPException:
+        raise
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="No embeddings found. Please build embeddings first.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/search-faces")
+async def search_faces(request: SearchFacesRequest):
+    """
+    Search for similar faces using FAISS index from engine.py.
+    Only the event's index shard is searched when `event_id` is given.
+    Returns one match per photo containing a face whose cosine similarity to the reference
+    is above `threshold`, best first, paginated with `offset` / `limit`.
+    With `reference_embeddings` (e.g. every face of a group selfie) all faces are searched in one
+    batched index call and combined per photo according to `mode`.
+    """
+    references = list(request.reference_embeddings or [])
+    if request.reference_embedding:
+        references.insert(0, request.reference_embedding)
+    if not references:
+        raise HTTPException(status_code=422, detail="reference_embedding or reference_embeddings is required")
+    try:
+        reference_emb = np.array(references, dtype='float32')
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Reference embeddings must all have the same length")
+    return await find_photos(reference_emb, request)
+
+@app.post("/api/search-faces/binary")
+async def search_faces_binary(request: Request, threshold: float = 0.6, mode: str = "any",
+                              event_id: Union[str, None] = None, offset: int = Query(0, ge=0),
+                              limit: int = Query(100, ge=1), use_clusters: bool = False):
+    """
+    Same as /api/search-faces with the reference faces sent as a binary embeddings body (see pack_embeddings,
+    e.g. a binary /api/extract-embeddings response forwarded as is) and the other parameters in the query string.
+    """
+    try:
+        reference_emb = unpack_embeddings(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not len(reference_emb):
+        raise HTTPException(status_code=422, detail="The body contains no face")
+    params = SearchFacesRequest(threshold=threshold, mode=mode, event_id=event_id, offset=offset, limit=limit,
+                                use_clusters=use_clusters)
+    return await find_photos(np.ascontiguousarray(reference_emb), params)
+
+class SelfieSearchRequest(BaseModel):
+    image: str  # selfie URL or data URI
+    all_faces: bool = False  # search every face of the selfie, combined according to `mode`, instead of the largest
+    mode: str = "any"
+    threshold: float = 0.6
+    event_id: Union[str, None] = None
+    offset: int = Field(0, ge=0)
+    limit: int = Field(100, ge=1)
+    use_clusters: bool = False
+
+@app.post("/api/search-by-selfie")
+async def search_by_selfie(request: SelfieSearchRequest):
+    """
+    Selfie in, photo list out: face extraction and search in one call, so the embedding never leaves the service.
+    The largest face of the selfie is searched (every face with `all_faces`); the response is the one of
+    /api/search-faces plus `num_faces`, the number of faces found in the selfie.
+    """
+    try:
+        data = await load_image_bytes(request.image)
+        timings = {}
+        faces = await asyncio.get_running_loop().run_in_executor(inference_pool, extract_faces, data, timings)
+        add_spans(timings)
+    except Exception as e:
+        metrics.inc("face_api_image_errors_total", source="selfie")
+        raise HTTPException(status_code=400, detail=f"Could not process the selfie: {e}")
+    metrics.inc("face_api_images_total", source="selfie")
+    vectors = faces["vectors"]
+    if not len(vectors):
+        return JSONResponse({"matches": [], "total": 0, "num_faces": 0})
+    if not request.all_faces:
+        areas = (faces["bbox"][:, 2] - faces["bbox"][:, 0]) * (faces["bbox"][:, 3] - faces["bbox"][:, 1])
+        vectors = vectors[[int(np.argmax(areas))]]
+    return await find_photos(vectors, request, extra={"num_faces": len(faces["vectors"])})
+
+class IngestPhoto(BaseModel):
+    source: str  # URL, data URI or path under JOBS_LOCAL_ROOT
+    id: Union[str, None] = None  # key stored in results and in the index; defaults to source
+
+class IngestJobRequest(BaseModel):
+    photos: List[IngestPhoto]
+    event_id: Union[str, None] = None
+    index: bool = True  # add the faces to the event's index shard when the job completes
+
+@app.post("/api/jobs")
+async def create_job(request: IngestJobRequest):
+    """
+    Enqueue a batch of photos for background face extraction. Returns immediately with the job;
+    follow progress with GET /api/jobs/{id} (polling) or GET /api/jobs/{id}/events (SSE).
+    """
+    if request.event_id:
+        try:
+            engine.event_data_dir(request.event_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    photos = [{"source": photo.source, "id": photo.id or photo.source} for photo in request.photos]
+    job = job_store.create(photos, request.event_id, request.index)
+    await job_queue.put(job["id"])
+    return job_summary(job)
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    return job_summary(load_job(job_id))
+
+@app.get("/api/jobs/{job_id}/results")
+async def get_job_results(job_id: str, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1)):
+    """Per-photo results written so far: {photo_id, num_faces, embeddings[, error]}."""
+    load_job(job_id)
+    results = job_store.results(job_id)
+    return {"results": results[offset:offset + limit], "total": len(results)}
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: the job summary each time it changes, until the job finishes."""
+    load_job(job_id)
+
+    async def stream():
+        last = None
+        while True:
+            summary = job_summary(load_job(job_id))
+            if summary != last:
+                yield f"data: {json.dumps(summary)}\n\n"
+                last = summary
+            if summary["status"] in ("done", "failed"):
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+def load_job(job_id: str) -> dict:
+    try:
+        return job_store.load(job_id)
+    except (FileNotFoundError, ValueError):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+def job_summary(job: dict) -> dict:
+    return {key: value for key, value in job.items() if key != "photos"}
+
+async def run_jobs():
+    """Process queued jobs one at a time, so index writes for an event never race."""
+    while True:
+        job_id = await job_queue.get()
+        job = job_store.load(job_id)
+        try:
+            await run_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.update(status="failed", error=str(e), finished_at=time.time())
+            job_store.save(job)
+
+async def run_job(job: dict):
+    """
+    Extract faces for every photo of the job with INGEST_CONCURRENCY photos in flight, appending
+    results to disk every INGEST_FLUSH_SIZE photos, then add them to the event index in one write.
+    """
+    existing = job_store.results(job["id"])
+    done = {row["photo_id"] for row in existing}
+    job.update(status="running", processed=len(existing), failed=sum(1 for row in existing if "error" in row),
+               faces=sum(row["num_faces"] for row in existing))
+    job_store.save(job)
+
+    semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    pending_rows = []
+
+    def flush():
+        job_store.append_results(job["id"], pending_rows)
+        job["processed"] += len(pending_rows)
+        job["failed"] += sum(1 for row in pending_rows if "error" in row)
+        job["faces"] += sum(row["num_faces"] for row in pending_rows)
+        pending_rows.clear()
+        job_store.save(job)
+
+    async def ingest(photo: dict):
+        async with semaphore:
+            try:
+                data = await load_image_bytes(photo["source"], local_root=JOBS_LOCAL_ROOT)
+                embeddings = await loop.run_in_executor(inference_pool, face_embeddings, data)
+                row = {"photo_id": photo["id"], "num_faces": len(embeddings), "embeddings": embeddings}
+                metrics.inc("face_api_images_total", source="job")
+                metrics.inc("face_api_faces_total", len(embeddings), source="job")
+            except Exception as e:
+                metrics.inc("face_api_image_errors_total", source="job")
+                row = {"photo_id": photo["id"], "num_faces": 0, "embeddings": [], "error": str(e)}
+        pending_rows.append(row)
+        if len(pending_rows) >= INGEST_FLUSH_SIZE:
+            flush()
+
+    await asyncio.gather(*(ingest(photo) for photo in job["photos"] if photo["id"] not in done))
+    flush()
+
+    if job["event_id"] and job["index"]:
+        await loop.run_in_executor(inference_pool, index_job_results, job)
+    job.update(status="done", finished_at=time.time())
+    job_store.save(job)
+
+def index_job_results(job: dict):
+    """Add every face found by the job to the event's index shard in a single save."""
+    vectors, paths, bboxes, num_faces = [], [], [], {}
+    for row in job_store.results(job["id"]):
+        if "error" in row:
+            continue
+        num_faces[row["photo_id"]] = row["num_faces"]
+        for embedding in row["embeddings"]:
+            vectors.append(embedding["vector"])
+            bboxes.append(embedding["bbox"])
+            paths.append(row["photo_id"])
+    engine.add_embeddings(vectors, paths, num_faces, bboxes, data_dir=engine.event_data_dir(job["event_id"]))
+
+@app.get("/api/events/{event_id}/people")
+async def event_people(event_id: str, min_size: int = Query(2, ge=1), offset: int = Query(0, ge=0),
+                       limit: int = Query(100, ge=1)):
+    """
+    "People in this event" gallery: one entry per identity cluster, most photographed first, with a
+    portrait face (photo_path + bbox). Requires `python engine.py cluster --event <event_id>`.
+    """
+    def load_people():
+        face_index = engine.get_index(engine.event_data_dir(event_id))
+        return face_index.people(min_size=min_size, offset=offset, limit=limit)
+
+    try:
+        # Shard load and cluster reads block, as in search_index
+        total, people = await asyncio.get_running_loop().run_in_executor(None, load_people)
+        return {"people": [with_thumbnail_url(person, event_id) for person in people], "total": total}
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="No embeddings found. Please build embeddings first.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/thumbnails/{name}")
+async def get_thumbnail(name: str, event_id: Union[str, None] = None):
+    """
+    Web-size thumbnail generated at index time (engine.sync_thumbnails), as referenced by the `thumbnail`
+    field of search and people results. Full-size photos are never read to answer a search.
+    """
+    try:
+        data_dir = engine.event_data_dir(event_id) if event_id else engine.DATA_DIR
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if name != os.path.basename(name) or not name.endswith(".jpg"):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    path = os.path.join(data_dir, engine.THUMBNAILS_DIR, name)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=3600"})
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text format: request and stage latency histograms, image/face counters, cache gauges."""
+    index_cache = engine.index_cache_stats()
+    cache = query_cache.stats()
+    gauges = {
+        "face_api_index_cache_indexes": index_cache["indexes"],
+        "face_api_index_cache_bytes": index_cache["bytes"],
+        "face_api_query_cache_entries": cache["entries"],
+        "face_api_query_cache_hits": cache["hits"],
+        "face_api_query_cache_misses": cache["misses"],
+        "face_api_jobs_queued": job_queue.qsize() if job_queue else 0,
+        "face_api_engine_import_seconds": ENGINE_IMPORT_S,
+    }
+    for name in ("model_load_s", "warmup_s"):
+        if engine.STARTUP[name] is not None:
+            gauges[f"face_api_{name[:-2]}_seconds"] = engine.STARTUP[name]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """Sample the Python stacks of every thread (inference pool included) and count identical stacks."""
+    own = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join([names.get(ident, str(ident))] + frames[::-1])] += 1
+        time.sleep(interval)
+    return stacks
+
+@app.get("/debug/profile")
+async def profile(seconds: float = 10.0, interval: float = 0.005):
+    """
+    Sampling profiler, enabled with ENABLE_PROFILER=1. Returns collapsed stacks ("frame;frame;... count"),
+    readable by flamegraph.pl or speedscope.
+    """
+    if not ENABLE_PROFILER:
+        raise HTTPException(status_code=404, detail="Profiler disabled, set ENABLE_PROFILER=1")
+    loop = asyncio.get_running_loop()
+    stacks = await loop.run_in_executor(None, sample_stacks, min(seconds, 60.0), max(interval, 0.001))
+    return PlainTextResponse("\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n")
+
 def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
     """Calculate cosine similarity between two vectors"""
     return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
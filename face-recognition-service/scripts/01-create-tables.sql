@@ -1,3 +1,6 @@
+-- Enable pgvector for the embedding column and similarity search
+CREATE EXTENSION IF NOT EXISTS vector;
+
 -- Create events table for storing event information
 CREATE TABLE IF NOT EXISTS events (
   id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -34,6 +37,48 @@ CREATE INDEX IF NOT EXISTS idx_photos_event_id ON photos(event_id);
 CREATE INDEX IF NOT EXISTS idx_face_embeddings_photo_id ON face_embeddings(photo_id);
 CREATE INDEX IF NOT EXISTS idx_events_status ON events(status);
 
+-- Approximate nearest-neighbour index on embeddings (cosine distance, operator <=>)
+CREATE INDEX IF NOT EXISTS idx_face_embeddings_embedding ON face_embeddings
+  USING hnsw (embedding vector_cosine_ops);
+
+-- Return the photos containing a face similar to query_embedding, best similarity first.
+-- Scans only the match_count nearest faces through the HNSW index, then keeps those whose
+-- cosine similarity is >= match_threshold and returns one row per photo.
+CREATE OR REPLACE FUNCTION match_photos(
+  query_embedding VECTOR(512),
+  match_threshold FLOAT DEFAULT 0.6,
+  filter_event_id UUID DEFAULT NULL,
+  match_count INT DEFAULT 500
+)
+RETURNS TABLE (photo_id UUID, similarity FLOAT)
+LANGUAGE plpgsql STABLE
+AS $$
+#variable_conflict use_column
+BEGIN
+  -- Keep scanning the index when the event filter discards candidates. hnsw.iterative_scan only
+  -- exists from pgvector 0.8; earlier versions reject the parameter, so it is set for this
+  -- transaction only when the installed extension supports it.
+  IF (SELECT string_to_array(extversion, '.')::INT[] >= ARRAY[0, 8]
+      FROM pg_extension WHERE extname = 'vector') THEN
+    PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+  END IF;
+
+  RETURN QUERY
+  SELECT nearest.photo_id, MAX(nearest.similarity) AS similarity
+  FROM (
+    SELECT fe.photo_id, 1 - (fe.embedding <=> query_embedding) AS similarity
+    FROM face_embeddings fe
+    JOIN photos p ON p.id = fe.photo_id
+    WHERE filter_event_id IS NULL OR p.event_id = filter_event_id
+    ORDER BY fe.embedding <=> query_embedding
+    LIMIT match_count
+  ) nearest
+  WHERE nearest.similarity >= match_threshold
+  GROUP BY nearest.photo_id
+  ORDER BY similarity DESC;
+END;
+$$;
+
 -- Enable Row Level Security
 ALTER TABLE events ENABLE ROW LEVEL SECURITY;
 ALTER TABLE photos ENABLE ROW LEVEL SECURITY;
@@ -1,30 +1,114 @@
 """
 Script to process uploaded photos and extract face embeddings using InsightFace.
 This script should be run after photos are uploaded to process them.
+
+Embeddings are written in batches spanning many faces and photos (see EmbeddingWriter).
+SUPABASE_URL may point at a local PostgREST / `supabase start` stack for testing.
 """
 
 import os
+import time
+import argparse
 import numpy as np
-from insightface.app import FaceAnalysis
-from supabase import create_client, Client
-import json
 
-# Initialize Supabase client
+# Supabase client, created on first use
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+_supabase = None
+
+
+def get_supabase():
+    global _supabase
+    if _supabase is None:
+        from supabase import create_client
+        _supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _supabase
+
+# InsightFace, loaded on first use with only the detection and recognition models
+_face_app = None
+
+
+def get_face_app():
+    global _face_app
+    if _face_app is None:
+        from insightface.app import FaceAnalysis
+        _face_app = FaceAnalysis(providers=['CPUExecutionProvider'], allowed_modules=['detection', 'recognition'])
+        _face_app.prepare(ctx_id=0, det_size=(640, 640))
+    return _face_app
+
+
+# Rows per insert request, and max seconds a row waits in the buffer
+BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 500))
+FLUSH_INTERVAL = float(os.environ.get("EMBEDDING_FLUSH_INTERVAL", 5.0))
+
+
+def encode_embedding(embedding) -> str:
+    """
+    Encode an embedding as a pgvector text literal ("[0.1,0.2,...]").
+    float32 precision is kept with 7 significant digits, about half the size of a JSON list of Python floats.
+    """
+    return "[" + ",".join(np.char.mod("%.7g", np.asarray(embedding, dtype=np.float32))) + "]"
+
+
+class EmbeddingWriter:
+    """
+    Buffers face embedding rows and writes them with one bulk insert per batch.
+
+    A batch is flushed when it reaches `batch_size` rows or when `flush_interval` seconds have passed
+    since the last flush. Photos are marked as processed only once all their faces have been written,
+    with one update per flush.
+
+    Each insert removes its rows from the buffer as soon as it succeeds: if a later insert fails, the
+    error is raised and calling flush() again only writes the rows still pending, without duplicates.
+    """
+
+    def __init__(self, client, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.photo_ids = []
+        self.last_flush = time.monotonic()
 
-# Initialize InsightFace
-app = FaceAnalysis(providers=['CPUExecutionProvider'])
-app.prepare(ctx_id=0, det_size=(640, 640))
+    def add_photo(self, photo_id: str, faces):
+        for face in faces:
+            self.rows.append({
+                'photo_id': photo_id,
+                'embedding': encode_embedding(face.embedding),
+                'bbox': {
+                    'x': float(face.bbox[0]),
+                    'y': float(face.bbox[1]),
+                    'width': float(face.bbox[2] - face.bbox[0]),
+                    'height': float(face.bbox[3] - face.bbox[1])
+                }
+            })
+        self.photo_ids.append(photo_id)
+        if len(self.rows) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        while self.rows:
+            batch = self.rows[:self.batch_size]
+            self.client.table('face_embeddings').insert(batch).execute()
+            del self.rows[:len(batch)]
+        if self.photo_ids:
+            self.client.table('photos').update({'processed': True}).in_('id', self.photo_ids).execute()
+            self.photo_ids = []
+        self.last_flush = time.monotonic()
 
-def process_photo(photo_id: str, image_path: str):
+
+def process_photo(photo_id: str, image_path: str, writer: EmbeddingWriter = None):
     """
     Process a single photo to extract face embeddings.
     
     Args:
         photo_id: UUID of the photo in the database
         image_path: Path or URL to the image file
+        writer: Batch writer shared across photos; without one the photo is written immediately
+
+    Errors while loading the image or detecting faces are reported for this photo, which is left
+    unprocessed. Database write errors are not caught here: they come from the shared writer and
+    concern the whole buffered batch, not this photo.
     """
     try:
         # Load image
@@ -40,54 +124,64 @@ def process_photo(photo_id: str, image_path: str):
             img = cv2.imread(image_path)
         
         # Detect faces
-        faces = app.get(img)
+        faces = get_face_app().get(img)
         
         print(f"Found {len(faces)} face(s) in photo {photo_id}")
         
-        # Store each face embedding
-        for face in faces:
-            embedding = face.embedding.tolist()
-            bbox = {
-                'x': float(face.bbox[0]),
-                'y': float(face.bbox[1]),
-                'width': float(face.bbox[2] - face.bbox[0]),
-                'height': float(face.bbox[3] - face.bbox[1])
-            }
-            
-            # Insert into database
-            supabase.table('face_embeddings').insert({
-                'photo_id': photo_id,
-                'embedding': embedding,
-                'bbox': json.dumps(bbox)
-            }).execute()
-        
-        # Mark photo as processed
-        supabase.table('photos').update({
-            'processed': True
-        }).eq('id', photo_id).execute()
-        
-        return len(faces)
-        
     except Exception as e:
         print(f"Error processing photo {photo_id}: {str(e)}")
         return 0
 
-def process_unprocessed_photos():
+    # Queue the faces for the next bulk insert
+    flush_now = writer is None
+    writer = writer or EmbeddingWriter(get_supabase())
+    writer.add_photo(photo_id, faces)
+    if flush_now:
+        writer.flush()
+
+    return len(faces)
+
+
+def delete_partial_embeddings(client, photo_ids, chunk_size: int = 200):
+    """
+    Delete the embeddings already written for photos that are not marked as processed.
+    They are left over by a run that stopped between an insert and the matching photos update,
+    and would otherwise be inserted a second time.
+    """
+    for start in range(0, len(photo_ids), chunk_size):
+        client.table('face_embeddings').delete().in_('photo_id', photo_ids[start:start + chunk_size]).execute()
+
+def process_unprocessed_photos(batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
     """
     Process all unprocessed photos in the database.
     """
+    client = get_supabase()
+
     # Get unprocessed photos
-    response = supabase.table('photos').select('*').eq('processed', False).execute()
+    response = client.table('photos').select('*').eq('processed', False).execute()
     photos = response.data
     
     print(f"Found {len(photos)} unprocessed photo(s)")
+    delete_partial_embeddings(client, [photo['id'] for photo in photos])
     
+    writer = EmbeddingWriter(client, batch_size=batch_size, flush_interval=flush_interval)
     total_faces = 0
-    for photo in photos:
-        faces_count = process_photo(photo['id'], photo['file_path'])
-        total_faces += faces_count
+    try:
+        for photo in photos:
+            faces_count = process_photo(photo['id'], photo['file_path'], writer=writer)
+            total_faces += faces_count
+        writer.flush()
+    except Exception as e:
+        print(f"Error writing face embeddings ({len(writer.rows)} row(s) not written, "
+              f"{len(writer.photo_ids)} photo(s) left unprocessed): {str(e)}")
+        raise
     
     print(f"Processing complete! Extracted {total_faces} face(s) from {len(photos)} photo(s)")
 
 if __name__ == "__main__":
-    process_unprocessed_photos()
+    parser = argparse.ArgumentParser(description="Extract face embeddings for unprocessed photos")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Face rows per insert request")
+    parser.add_argument("--flush-interval", type=float, default=FLUSH_INTERVAL,
+                        help="Max seconds before buffered rows are written")
+    args = parser.parse_args()
+    process_unprocessed_photos(batch_size=args.batch_size, flush_interval=args.flush_interval)
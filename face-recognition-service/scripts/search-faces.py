@@ -1,11 +1,14 @@
 """
 Script to search for matching faces given a reference photo.
 This uses cosine similarity to find similar face embeddings.
+
+By default the search runs in Postgres through the `match_photos` RPC (pgvector HNSW index,
+see 01-create-tables.sql): one query returns the matching photo IDs, whatever the event size.
+The `client` mode downloads every embedding and compares them in Python.
 """
 
 import os
 import numpy as np
-from insightface.app import FaceAnalysis
 from supabase import create_client, Client
 import json
 
@@ -14,9 +17,16 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# Initialize InsightFace
-app = FaceAnalysis(providers=['CPUExecutionProvider'])
-app.prepare(ctx_id=0, det_size=(640, 640))
+# InsightFace, loaded on first use with only the detection and recognition models
+_face_app = None
+
+def get_face_app():
+    global _face_app
+    if _face_app is None:
+        from insightface.app import FaceAnalysis
+        _face_app = FaceAnalysis(providers=['CPUExecutionProvider'], allowed_modules=['detection', 'recognition'])
+        _face_app.prepare(ctx_id=0, det_size=(640, 640))
+    return _face_app
 
 def cosine_similarity(embedding1, embedding2):
     """Calculate cosine similarity between two embeddings."""
@@ -47,7 +57,7 @@ def extract_reference_embedding(image_path: str):
             img = cv2.imread(image_path)
         
         # Detect faces
-        faces = app.get(img)
+        faces = get_face_app().get(img)
         
         if len(faces) == 0:
             print("No face detected in reference image")
@@ -62,7 +72,11 @@ def extract_reference_embedding(image_path: str):
         print(f"Error extracting reference embedding: {str(e)}")
         return None
 
-def search_similar_faces(reference_embedding, threshold=0.6, event_id=None):
+def to_pgvector(embedding) -> str:
+    """Encode an embedding as a pgvector text literal ("[0.1,0.2,...]")."""
+    return "[" + ",".join(np.char.mod("%.7g", np.asarray(embedding, dtype=np.float32))) + "]"
+
+def search_similar_faces(reference_embedding, threshold=0.6, event_id=None, mode="rpc", match_count=500):
     """
     Search for photos containing similar faces.
     
@@ -70,10 +84,15 @@ def search_similar_faces(reference_embedding, threshold=0.6, event_id=None):
         reference_embedding: Face embedding to search for
         threshold: Similarity threshold (0-1, higher = more strict)
         event_id: Optional event ID to filter results
+        mode: "rpc" to search in the database, "client" to compare every embedding in Python
+        match_count: Number of nearest faces considered by the database search
         
     Returns:
         List of matching photo IDs with similarity scores
     """
+    if mode == "rpc":
+        return search_similar_faces_rpc(reference_embedding, threshold, event_id, match_count)
+
     try:
         # Get all face embeddings from database
         query = supabase.table('face_embeddings').select('id, photo_id, embedding')
@@ -117,6 +136,26 @@ def search_similar_faces(reference_embedding, threshold=0.6, event_id=None):
         print(f"Error searching faces: {str(e)}")
         return []
 
+def search_similar_faces_rpc(reference_embedding, threshold=0.6, event_id=None, match_count=500):
+    """
+    Search through the `match_photos` RPC: the database returns one row per matching photo.
+    """
+    try:
+        response = supabase.rpc('match_photos', {
+            'query_embedding': to_pgvector(reference_embedding),
+            'match_threshold': threshold,
+            'filter_event_id': event_id,
+            'match_count': match_count,
+        }).execute()
+        result = [{'photo_id': row['photo_id'], 'similarity': float(row['similarity'])} for row in response.data]
+        
+        print(f"Found {len(result)} matching photo(s)")
+        return result
+        
+    except Exception as e:
+        print(f"Error searching faces: {str(e)}")
+        return []
+
 def get_photo_urls(photo_ids):
     """Get the URLs for a list of photo IDs."""
     if not photo_ids:
@@ -130,19 +169,20 @@ if __name__ == "__main__":
     import sys
     
     if len(sys.argv) < 2:
-        print("Usage: python search-faces.py <reference_image_path> [threshold] [event_id]")
+        print("Usage: python search-faces.py <reference_image_path> [threshold] [event_id] [rpc|client]")
         sys.exit(1)
     
     reference_path = sys.argv[1]
     threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 0.6
     event_id = sys.argv[3] if len(sys.argv) > 3 else None
+    mode = sys.argv[4] if len(sys.argv) > 4 else "rpc"
     
     # Extract reference embedding
     ref_embedding = extract_reference_embedding(reference_path)
     
     if ref_embedding is not None:
         # Search for matches
-        matches = search_similar_faces(ref_embedding, threshold, event_id)
+        matches = search_similar_faces(ref_embedding, threshold, event_id, mode=mode)
         
         # Get photo URLs
         photo_ids = [m['photo_id'] for m in matches]
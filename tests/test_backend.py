@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'face-recognition-service', 'python-backend'))
+import main
+
+
+def faces(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'vectors': rng.normal(size=(n, 512)).astype('float32'),
+        'confidence': rng.random(n).astype('float32'),
+        'bbox': rng.random((n, 4)).astype('float32') * 100,
+    }
+
+
+def test_pack_unpack_round_trip():
+    results = [{'image_index': 0, 'faces': faces(2)},
+               {'image_index': 1, 'error': 'download failed'},
+               {'image_index': 2, 'faces': faces(0)},
+               {'image_index': 3, 'faces': faces(3, seed=1)}]
+    data = main.pack_embeddings(results)
+    magic, version, dim, n_images, n_faces = main.BINARY_HEADER.unpack_from(data)
+    assert (magic, version, dim, n_images, n_faces) == (main.BINARY_MAGIC, main.BINARY_VERSION, 512, 4, 5)
+    counts = np.frombuffer(data, dtype='<u4', count=4, offset=main.BINARY_HEADER.size)
+    assert counts.tolist() == [2, 0, 0, 3]
+
+    vectors = main.unpack_embeddings(data)
+    expected = np.concatenate([results[0]['faces']['vectors'], results[3]['faces']['vectors']])
+    assert vectors.shape == (5, 512)
+    np.testing.assert_array_equal(vectors, expected)
+    # Confidences and bboxes follow the counts, 4-byte aligned
+    offset = main.BINARY_HEADER.size + 4 * n_images
+    confidence = np.frombuffer(data, dtype='<f4', count=5, offset=offset)
+    bbox = np.frombuffer(data, dtype='<f4', count=20, offset=offset + 4 * 5).reshape(5, 4)
+    np.testing.assert_array_equal(confidence, np.concatenate([results[0]['faces']['confidence'],
+                                                              results[3]['faces']['confidence']]))
+    np.testing.assert_array_equal(bbox, np.concatenate([results[0]['faces']['bbox'], results[3]['faces']['bbox']]))
+
+
+def test_pack_without_faces():
+    data = main.pack_embeddings([{'image_index': 0, 'error': 'bad image'}])
+    vectors = main.unpack_embeddings(data)
+    assert vectors.shape == (0, 512)
+
+
+@pytest.mark.parametrize('mutate', [
+    pytest.param(lambda data: data[:10], id='shorter-than-header'),
+    pytest.param(lambda data: b'XXXX' + data[4:], id='bad-magic'),
+    pytest.param(lambda data: data[:4] + (2).to_bytes(2, 'little') + data[6:], id='unknown-version'),
+    pytest.param(lambda data: data[:-4], id='truncated'),
+    pytest.param(lambda data: data + b'\0\0\0\0', id='trailing-bytes'),
+    pytest.param(lambda data: data[:12] + (7).to_bytes(4, 'little') + data[16:], id='face-count-mismatch'),
+])
+def test_unpack_malformed(mutate):
+    data = main.pack_embeddings([{'image_index': 0, 'faces': faces(2)}])
+    with pytest.raises(ValueError):
+        main.unpack_embeddings(mutate(data))
+
+
+@pytest.mark.parametrize('method, url, body', [
+    ('post', '/api/search-faces', {'reference_embedding': [0.1] * 512, 'offset': -5, 'limit': 3}),
+    ('post', '/api/search-faces', {'reference_embedding': [0.1] * 512, 'limit': 0}),
+    ('post', '/api/search-by-selfie', {'image': 'https://example.com/selfie.jpg', 'offset': -1}),
+    ('post', '/api/search-faces/binary?offset=-5&limit=3', None),
+    ('get', '/api/jobs/abc/results?limit=0', None),
+    ('get', '/api/events/e1/people?offset=-1', None),
+])
+def test_pagination_is_validated(method, url, body):
+    client = TestClient(main.app)
+    response = client.post(url, json=body) if method == 'post' else client.get(url)
+    assert response.status_code == 422
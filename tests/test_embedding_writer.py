@@ -0,0 +1,103 @@
+import importlib.util
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'face-recognition-service', 'scripts',
+                      'process-face-embeddings.py')
+spec = importlib.util.spec_from_file_location('process_face_embeddings', SCRIPT)
+process_face_embeddings = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(process_face_embeddings)
+EmbeddingWriter = process_face_embeddings.EmbeddingWriter
+
+
+class FakeQuery:
+    def __init__(self, client, table, action, payload):
+        self.client, self.table, self.action, self.payload = client, table, action, payload
+
+    def in_(self, column, values):
+        self.payload = (self.payload, column, list(values))
+        return self
+
+    def execute(self):
+        if self.action == 'insert':
+            self.client.insert_attempts += 1
+            if self.client.insert_attempts in self.client.fail_on:
+                raise RuntimeError('insert failed')
+        self.client.calls.append((self.table, self.action, self.payload))
+        return SimpleNamespace(data=[])
+
+
+class FakeClient:
+    """Records the queries that succeeded; the insert attempts numbered in `fail_on` raise."""
+
+    def __init__(self, fail_on=()):
+        self.calls = []
+        self.insert_attempts = 0
+        self.fail_on = set(fail_on)
+
+    def table(self, name):
+        return SimpleNamespace(
+            insert=lambda rows: FakeQuery(self, name, 'insert', list(rows)),
+            update=lambda values: FakeQuery(self, name, 'update', values),
+        )
+
+    def inserted(self):
+        return [call[2] for call in self.calls if call[1] == 'insert']
+
+    def updates(self):
+        return [call[2] for call in self.calls if call[1] == 'update']
+
+
+def faces(n, offset=0):
+    return [SimpleNamespace(embedding=np.full(4, offset + i, dtype=np.float32),
+                            bbox=np.array([0, 0, 10, 10], dtype=np.float32)) for i in range(n)]
+
+
+def test_flush_splits_rows_in_batches():
+    client = FakeClient()
+    writer = EmbeddingWriter(client, batch_size=3, flush_interval=3600)
+    writer.add_photo('a', faces(2))
+    writer.add_photo('b', faces(2, offset=2))  # 4 rows >= 3: flush
+    assert [len(batch) for batch in client.inserted()] == [3, 1]
+    assert client.updates() == [({'processed': True}, 'id', ['a', 'b'])]
+    assert writer.rows == [] and writer.photo_ids == []
+
+    writer.flush()  # nothing buffered: no request
+    assert len(client.calls) == 3
+
+
+def test_failed_flush_is_retried_without_duplicates():
+    client = FakeClient(fail_on={2})
+    writer = EmbeddingWriter(client, batch_size=2, flush_interval=3600)
+    writer.rows = [{'photo_id': 'a', 'embedding': str(i)} for i in range(5)]
+    writer.photo_ids = ['a']
+
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert [len(batch) for batch in client.inserted()] == [2]
+    assert len(writer.rows) == 3
+    assert client.updates() == []  # photo not marked before all its rows are written
+
+    writer.flush()
+
+    embeddings = [row['embedding'] for batch in client.inserted() for row in batch]
+    assert embeddings == ['0', '1', '2', '3', '4']
+    assert [len(batch) for batch in client.inserted()] == [2, 2, 1]
+    assert client.updates() == [({'processed': True}, 'id', ['a'])]
+    assert writer.rows == [] and writer.photo_ids == []
+
+
+def test_write_errors_are_not_blamed_on_the_photo(monkeypatch):
+    client = FakeClient(fail_on={1})
+    writer = EmbeddingWriter(client, batch_size=1, flush_interval=3600)
+    monkeypatch.setattr(process_face_embeddings, 'get_face_app',
+                        lambda: SimpleNamespace(get=lambda img: faces(1)))
+
+    with pytest.raises(RuntimeError):
+        process_face_embeddings.process_photo('a', 'a.jpg', writer=writer)
+    assert len(writer.rows) == 1
+    writer.flush()
+    assert [len(batch) for batch in client.inserted()] == [1]
@@ -0,0 +1,244 @@
+import os
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import engine
+
+
+def jpeg(width, height):
+    ok, data = cv2.imencode('.jpg', np.zeros((height, width, 3), dtype=np.uint8))
+    assert ok
+    return data.tobytes()
+
+
+def with_exif(data, payload_size=300):
+    # APP1 segment before the SOF, with 0xFF bytes inside the payload that must not be read as markers
+    payload = b'Exif\0\0' + bytes([0xFF, 0xC0] * (payload_size // 2))
+    app1 = b'\xff\xe1' + (len(payload) + 2).to_bytes(2, 'big') + payload
+    return data[:2] + app1 + data[2:]
+
+
+def test_jpeg_size():
+    assert engine._jpeg_size(jpeg(640, 480)) == (640, 480)
+
+
+def test_jpeg_size_after_exif():
+    data = with_exif(jpeg(800, 600))
+    assert engine._jpeg_size(data) == (800, 600)
+    assert engine._jpeg_size(data[:engine._JPEG_HEADER_BYTES]) == (800, 600)
+    # The reduced decode still gives the full image size once scaled back
+    img, scale = engine.load_image(data, max_side=200)
+    assert img is not None and max(img.shape[:2]) == 200
+    assert scale == pytest.approx(4.0)
+
+
+def test_jpeg_size_not_jpeg():
+    ok, png = cv2.imencode('.png', np.zeros((10, 10, 3), dtype=np.uint8))
+    assert engine._jpeg_size(png.tobytes()) is None
+    assert engine._jpeg_size(jpeg(64, 64)[:8]) is None
+
+
+def face_index():
+    # 5 faces: photos a (faces 0, 1), b (2), c (3, 4)
+    photo_paths = np.array(['a', 'b', 'c'])
+    photo_ids = np.array([0, 0, 1, 2, 2])
+    bboxes = np.arange(20, dtype='float32').reshape(5, 4)
+    return engine.FaceIndex(None, None, photo_ids, photo_paths, {'a': 2, 'b': 1, 'c': 2}, 'out', bboxes=bboxes)
+
+
+def test_group_by_photo_any():
+    index = face_index()
+    # Query 0 finds faces 0, 2, 3; query 1 finds faces 1, 4
+    similarities = [0.7, 0.9, 0.6, 0.8, 0.65]
+    indices = [0, 2, 3, 1, 4]
+    query_ids = [0, 0, 0, 1, 1]
+    total, photos = index.group_by_photo(similarities, indices, query_ids=query_ids, n_queries=2)
+    assert total == 3
+    assert [photo['photo_path'] for photo in photos] == ['b', 'a', 'c']
+    assert [photo['similarity'] for photo in photos] == pytest.approx([0.9, 0.8, 0.65])
+    a = photos[1]
+    assert a['face_index'] == 1 and a['bbox'] == [4, 5, 6, 7]
+    assert a['matched_faces'] == 2 and a['matched_queries'] == [0, 1] and a['num_faces'] == 2
+    assert a['thumbnail'] is None and a['timestamp'] is None
+
+
+def test_group_by_photo_all():
+    index = face_index()
+    similarities = [0.7, 0.9, 0.6, 0.8, 0.65]
+    indices = [0, 2, 3, 1, 4]
+    query_ids = [0, 0, 0, 1, 1]
+    total, photos = index.group_by_photo(similarities, indices, query_ids=query_ids, n_queries=2, mode='all')
+    # b is only found by query 0; the score is the weakest of the best similarities per query
+    assert total == 2
+    assert [(photo['photo_path'], photo['similarity']) for photo in photos] == [
+        ('a', pytest.approx(0.7)), ('c', pytest.approx(0.6))]
+
+
+def test_group_by_photo_pagination_and_padding():
+    index = face_index()
+    # range_search-style padding (-1) is ignored
+    similarities = [0.9, 0.8, 0.7, 0.0]
+    indices = [2, 0, 3, -1]
+    total, photos = index.group_by_photo(similarities, indices, offset=1, limit=1)
+    assert total == 3
+    assert [photo['photo_path'] for photo in photos] == ['a']
+    total, photos = index.group_by_photo(similarities, indices, offset=3, limit=10)
+    assert total == 3 and photos == []
+    assert index.group_by_photo(np.empty(0, 'float32'), np.empty(0, 'int64'), mode='all') == (0, [])
+    with pytest.raises(ValueError):
+        index.group_by_photo(similarities, indices, mode='best')
+
+
+def test_get_index_loads_outside_the_global_lock(monkeypatch):
+    loaded = []
+    release = threading.Event()
+
+    def load(data_dir):
+        loaded.append(data_dir)
+        if data_dir == 'cold':
+            release.wait(5)
+        index = face_index()
+        index.version = 1
+        return index
+
+    monkeypatch.setattr(engine, 'index_version', lambda data_dir: 1)
+    monkeypatch.setattr(engine.FaceIndex, 'load', staticmethod(load))
+    monkeypatch.setattr(engine, '_INDEXES', engine.OrderedDict())
+    monkeypatch.setattr(engine, '_LOAD_LOCKS', {})
+    hot = engine.get_index('hot')
+
+    results = []
+    cold_loads = [threading.Thread(target=lambda: results.append(engine.get_index('cold'))) for _ in range(2)]
+    for thread in cold_loads:
+        thread.start()
+    time.sleep(0.1)
+    # A search on a cached shard does not wait for the cold load
+    start = time.perf_counter()
+    assert engine.get_index('hot') is hot
+    assert time.perf_counter() - start < 0.05
+    release.set()
+    for thread in cold_loads:
+        thread.join()
+    # Concurrent requests for the same cold shard load it once
+    assert loaded == ['hot', 'cold']
+    assert results[0] is results[1]
+
+
+def embeddings(n, d=64, seed=0):
+    rng = np.random.default_rng(seed)
+    return engine.normalize_embeddings(rng.normal(size=(n, d)))
+
+
+@pytest.mark.parametrize('storage,tolerance', [('float32', 0), ('float16', 1e-3)])
+def test_embeddings_round_trip(tmp_path, storage, tolerance):
+    vectors = embeddings(100)
+    path = str(tmp_path / engine.EMBEDDINGS_FILE)
+    assert engine.write_embeddings(path, vectors, storage=storage) == storage
+    for mmap in (False, True):
+        read = engine.read_embeddings(path, mmap=mmap)
+        assert read.dtype == storage and read.shape == vectors.shape
+        np.testing.assert_allclose(read, vectors, atol=tolerance)
+
+
+@pytest.fixture(scope='module')
+def pq_data_dir(tmp_path_factory):
+    # PQ training is slow: one data dir, just big enough for PQ, is shared by the PQ tests
+    data_dir = str(tmp_path_factory.mktemp('pq'))
+    vectors = embeddings(256 * engine.MIN_POINTS_PER_CENTROID)
+    engine.save_index(vectors, [f'p{i // 2}' for i in range(len(vectors))], {}, 'out', data_dir=data_dir,
+                      storage='pq')
+    return data_dir, vectors
+
+
+def test_embeddings_round_trip_pq(tmp_path, pq_data_dir):
+    data_dir, vectors = pq_data_dir
+    read = engine.read_embeddings(os.path.join(data_dir, engine.EMBEDDINGS_FILE), mmap=True)
+    assert isinstance(read, engine.PQEmbeddings)
+    assert read.shape == vectors.shape and read.nbytes == len(vectors) * engine.PQ_M
+    # Decoded vectors stay close to the originals, and writing them back keeps the same codes
+    assert np.mean(np.sum(read[:] * vectors, axis=1)) > 0.9
+    np.testing.assert_array_equal(read[3], read[:][3])
+    path = str(tmp_path / engine.EMBEDDINGS_FILE)
+    assert engine.write_embeddings(path, read, storage='pq') == 'pq'
+    np.testing.assert_array_equal(engine.read_embeddings(path).codes, read.codes)
+
+
+def test_embeddings_pq_falls_back_to_float16(tmp_path):
+    path = str(tmp_path / engine.EMBEDDINGS_FILE)
+    assert engine.write_embeddings(path, embeddings(100), storage='pq') == 'float16'
+    assert engine.read_embeddings(path).dtype == 'float16'
+
+
+def test_embeddings_version_check(tmp_path):
+    path = str(tmp_path / engine.EMBEDDINGS_FILE)
+    engine.write_embeddings(path, embeddings(10))
+    with open(path, 'r+b') as f:
+        f.seek(8)
+        f.write((engine._EMBEDDINGS_VERSION + 1).to_bytes(2, 'little'))
+    with pytest.raises(ValueError, match='non supporté'):
+        engine.read_embeddings(path)
+    with open(path, 'wb') as f:
+        f.write(b'not an embeddings file')
+    with pytest.raises(ValueError):
+        engine.read_embeddings(path)
+
+
+def test_pq_embeddings_extend(pq_data_dir):
+    data_dir, vectors = pq_data_dir
+    encoded = engine.read_embeddings(os.path.join(data_dir, engine.EMBEDDINGS_FILE))
+    new = embeddings(10, seed=1)
+    extended = encoded.extend([0, 5, 7], new)
+    assert extended.pq is encoded.pq and extended.shape == (13, vectors.shape[1])
+    np.testing.assert_array_equal(extended.codes[:3], encoded.codes[[0, 5, 7]])
+    np.testing.assert_array_equal(extended.codes[3:], encoded.pq.compute_codes(new))
+    assert len(encoded.extend([1], np.zeros((0, vectors.shape[1])))) == 1
+
+
+@pytest.mark.parametrize('storage,index_class', [('float32', 'IndexFlatIP'), ('float16', 'IndexScalarQuantizer')])
+def test_flat_index_uses_the_storage(tmp_path, storage, index_class):
+    vectors = embeddings(100)
+    engine.save_index(vectors, [f'p{i // 2}' for i in range(len(vectors))], {}, 'out', data_dir=str(tmp_path),
+                      storage=storage)
+    index = engine.load_faiss_index(str(tmp_path))
+    assert type(index).__name__ == index_class and index.ntotal == len(vectors)
+    _, found = index.search(vectors[:20], 1)
+    np.testing.assert_array_equal(found.ravel(), np.arange(20))
+
+
+def test_flat_index_shares_the_pq_codes(pq_data_dir):
+    data_dir, vectors = pq_data_dir
+    index = engine.load_faiss_index(data_dir)
+    stored = engine.read_embeddings(os.path.join(data_dir, engine.EMBEDDINGS_FILE))
+    assert isinstance(index, engine.faiss.IndexPQ) and index.ntotal == len(vectors)
+    codes = engine.faiss.vector_to_array(index.codes).reshape(index.ntotal, index.code_size)
+    np.testing.assert_array_equal(codes, stored.codes)
+    np.testing.assert_array_equal(engine.faiss.vector_to_array(index.pq.centroids),
+                                  engine.faiss.vector_to_array(stored.pq.centroids))
+
+
+def test_load_legacy_npz(tmp_path):
+    vectors = embeddings(3)
+    np.savez(tmp_path / engine.LEGACY_EMBEDDINGS_FILE, embeddings=vectors)
+    with open(tmp_path / engine.META_FILE, 'wb') as f:
+        engine.pickle.dump({'image_paths': ['b', 'a', 'b'], 'num_faces_per_image': {'a': 1, 'b': 2},
+                            'output_folder': 'out'}, f)
+    loaded, image_paths, num_faces, output_folder = engine.load_embeddings(str(tmp_path))
+    np.testing.assert_array_equal(loaded, vectors)
+    assert list(image_paths) == ['b', 'a', 'b'] and num_faces == {'a': 1, 'b': 2} and output_folder == 'out'
+
+
+def test_load_v1(tmp_path):
+    vectors = embeddings(3)
+    np.save(tmp_path / engine.V1_EMBEDDINGS_FILE, vectors)
+    np.save(tmp_path / engine.V1_PATHS_FILE, np.array(['b', 'a', 'b']))
+    with open(tmp_path / engine.META_FILE, 'wb') as f:
+        engine.pickle.dump({'format': 1, 'num_faces_per_image': {'a': 1, 'b': 2}, 'output_folder': 'out'}, f)
+    loaded, photo_ids, photo_paths, _ = engine.load_data(str(tmp_path), mmap=True)
+    np.testing.assert_array_equal(loaded, vectors)
+    assert list(photo_paths[photo_ids]) == ['b', 'a', 'b']